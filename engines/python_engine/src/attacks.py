@@ -0,0 +1,189 @@
+ALL_SQUARES = (1 << 64) - 1
+
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+NOT_FILE_A = ALL_SQUARES ^ FILE_A
+NOT_FILE_H = ALL_SQUARES ^ FILE_H
+
+RANK_1 = 0xFF
+RANK_3 = RANK_1 << 16
+RANK_6 = RANK_1 << 40
+RANK_8 = RANK_1 << 56
+
+
+def _leaper_attacks(square, deltas):
+    """
+    Build the attack bitboard of a piece on `square` which jumps by each (dr, df) in `deltas`
+    """
+
+    rank, file = square >> 3, square & 7
+    attacks = 0
+
+    for dr, df in deltas:
+        move_rank, move_file = rank + dr, file + df
+        if 0 <= move_rank <= 7 and 0 <= move_file <= 7:
+            attacks |= 1 << (8 * move_rank + move_file)
+
+    return attacks
+
+
+# fmt: off
+KNIGHT_DELTAS = ((2, -1), (2, 1), (1, 2), (1, -2), (-2, 1), (-2, -1), (-1, -2), (-1, 2))
+KING_DELTAS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+WHITE_PAWN_DELTAS = ((1, -1), (1, 1))
+BLACK_PAWN_DELTAS = ((-1, -1), (-1, 1))
+# fmt: on
+
+# Attack tables indexed by square, built once at import
+KNIGHT_ATTACKS = [_leaper_attacks(square, KNIGHT_DELTAS) for square in range(64)]
+KING_ATTACKS = [_leaper_attacks(square, KING_DELTAS) for square in range(64)]
+
+# Squares attacked by a pawn of the given colour standing on the square
+WHITE_PAWN_ATTACKS = [_leaper_attacks(square, WHITE_PAWN_DELTAS) for square in range(64)]
+BLACK_PAWN_ATTACKS = [_leaper_attacks(square, BLACK_PAWN_DELTAS) for square in range(64)]
+
+
+def pawn_attacks_for(is_white):
+    """
+    Get the pawn attack table for the specified colour
+    """
+
+    return WHITE_PAWN_ATTACKS if is_white else BLACK_PAWN_ATTACKS
+
+
+def pawn_attacks_bb(pawn_bb, is_white):
+    """
+    Get every square attacked by a set of pawns of the specified colour, computed set-wise by
+    shifting the whole bitboard
+    """
+
+    if is_white:
+        return ((pawn_bb << 7) & NOT_FILE_H | (pawn_bb << 9) & NOT_FILE_A) & ALL_SQUARES
+
+    return (pawn_bb >> 9) & NOT_FILE_H | (pawn_bb >> 7) & NOT_FILE_A
+
+
+ROOK_DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+BISHOP_DIRECTIONS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+
+
+def _ray_squares(square, dr, df):
+    """
+    List the squares from `square` (exclusive) to the edge of the board in one direction
+    """
+
+    squares = []
+
+    rank, file = (square >> 3) + dr, (square & 7) + df
+    while 0 <= rank <= 7 and 0 <= file <= 7:
+        squares.append(8 * rank + file)
+        rank += dr
+        file += df
+
+    return squares
+
+
+def _slider_tables(directions):
+    """
+    Build the relevant occupancy mask and the occupancy -> attacks table of every square for a
+    slider moving in `directions`
+
+    The mask leaves out the last square of each ray as a piece there can never block anything,
+    and every subset of the mask is enumerated with the carry-rippler trick
+    """
+
+    masks = []
+    tables = []
+
+    for square in range(64):
+        rays = [_ray_squares(square, dr, df) for dr, df in directions]
+
+        mask = 0
+        for ray in rays:
+            for ray_square in ray[:-1]:
+                mask |= 1 << ray_square
+
+        table = {}
+        subset = 0
+        while True:
+            attacks = 0
+            for ray in rays:
+                for ray_square in ray:
+                    attacks |= 1 << ray_square
+                    # First blocker of the ray
+                    if (subset >> ray_square) & 1:
+                        break
+
+            table[subset] = attacks
+
+            subset = (subset - mask) & mask
+            if subset == 0:
+                break
+
+        masks.append(mask)
+        tables.append(table)
+
+    return masks, tables
+
+
+# Sliding attacks are found with a single lookup: TABLE[square][occupied & MASK[square]]
+ROOK_MASKS, ROOK_TABLES = _slider_tables(ROOK_DIRECTIONS)
+BISHOP_MASKS, BISHOP_TABLES = _slider_tables(BISHOP_DIRECTIONS)
+
+
+def rook_attacks(square, occupied):
+    """
+    Get the squares attacked by a rook on `square`, including the first blocker of each ray
+    """
+
+    return ROOK_TABLES[square][occupied & ROOK_MASKS[square]]
+
+
+def bishop_attacks(square, occupied):
+    """
+    Get the squares attacked by a bishop on `square`, including the first blocker of each ray
+    """
+
+    return BISHOP_TABLES[square][occupied & BISHOP_MASKS[square]]
+
+
+def queen_attacks(square, occupied):
+    """
+    Get the squares attacked by a queen on `square`, including the first blocker of each ray
+    """
+
+    return (
+        ROOK_TABLES[square][occupied & ROOK_MASKS[square]]
+        | BISHOP_TABLES[square][occupied & BISHOP_MASKS[square]]
+    )
+
+
+def _line_tables():
+    """
+    Build the BETWEEN and LINE tables for every pair of squares on a shared rank, file or diagonal
+
+    BETWEEN[a][b] holds the squares strictly between a and b, and LINE[a][b] the whole board line
+    through both, including a and b. Both are empty if the squares aren't aligned
+    """
+
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+
+    for square in range(64):
+        for dr, df in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+            ray = _ray_squares(square, dr, df)
+
+            full_line = 1 << square
+            for line_square in ray + _ray_squares(square, -dr, -df):
+                full_line |= 1 << line_square
+
+            between_bb = 0
+            for ray_square in ray:
+                between[square][ray_square] = between_bb
+                line[square][ray_square] = full_line
+                between_bb |= 1 << ray_square
+
+    return between, line
+
+
+BETWEEN, LINE = _line_tables()
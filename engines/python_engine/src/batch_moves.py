@@ -0,0 +1,576 @@
+import numpy as np
+
+from attacks import KNIGHT_ATTACKS
+from gamestate import BK, BQ, WK, WQ
+from move_encoding import (
+    CAPTURE,
+    DOUBLE_PUSH,
+    EP_CAPTURE,
+    KING_CASTLE,
+    PROMO_CAPTURE_N,
+    PROMO_N,
+    QUEEN_CASTLE,
+    QUIET,
+)
+
+# Batched move generation for many positions at once, e.g. for datagen and analysis jobs
+#
+# A batch is an (N, 12) uint64 array of bitboards per position: white pawn, knight, bishop, rook,
+# queen and king, followed by the same for black. Side to move, castling rights and the en passant
+# square are (N,) arrays alongside it, using the same encodings as `SearchState`
+#
+# `find_legal_moves` stays the reference implementation, see `verify_against_reference`
+
+U64 = np.uint64
+
+ALL_SQUARES = U64(0xFFFFFFFFFFFFFFFF)
+NOT_FILE_A = U64(0xFEFEFEFEFEFEFEFE)
+NOT_FILE_H = U64(0x7F7F7F7F7F7F7F7F)
+NOT_FILE_AB = U64(0xFCFCFCFCFCFCFCFC)
+NOT_FILE_GH = U64(0x3F3F3F3F3F3F3F3F)
+RANK_1 = U64(0xFF)
+RANK_3 = U64(0xFF << 16)
+RANK_6 = U64(0xFF << 40)
+RANK_8 = U64(0xFF << 56)
+
+# (shift, wrap mask) of a one square step in each direction, positive shifts move towards h8
+NORTH = (8, ALL_SQUARES)
+SOUTH = (-8, ALL_SQUARES)
+EAST = (1, NOT_FILE_A)
+WEST = (-1, NOT_FILE_H)
+NORTH_EAST = (9, NOT_FILE_A)
+NORTH_WEST = (7, NOT_FILE_H)
+SOUTH_EAST = (-7, NOT_FILE_A)
+SOUTH_WEST = (-9, NOT_FILE_H)
+
+ORTHOGONAL_DIRECTIONS = (NORTH, SOUTH, EAST, WEST)
+DIAGONAL_DIRECTIONS = (NORTH_EAST, NORTH_WEST, SOUTH_EAST, SOUTH_WEST)
+
+KNIGHT_TABLE = np.array(KNIGHT_ATTACKS, dtype=U64)
+
+_HAS_BITWISE_COUNT = hasattr(np, "bitwise_count")
+
+
+def _raw_shift(bb, amount):
+    """
+    Shift bitboards towards h8 by `amount` squares, or towards a1 if negative
+    """
+
+    if amount > 0:
+        return bb << U64(amount)
+    return bb >> U64(-amount)
+
+
+def _shift(bb, direction):
+    """
+    Move every bit one step in `direction`, dropping bits which would wrap around the board
+    """
+
+    amount, wrap_mask = direction
+    return _raw_shift(bb, amount) & wrap_mask
+
+
+def _slide(sliders, empty, direction):
+    """
+    Kogge-Stone fill: squares attacked along `direction` by every slider in `sliders`, up to and
+    including the first occupied square
+    """
+
+    amount, wrap_mask = direction
+    propagate = empty & wrap_mask
+
+    for step in (amount, 2 * amount, 4 * amount):
+        sliders = sliders | (propagate & _raw_shift(sliders, step))
+        propagate = propagate & _raw_shift(propagate, step)
+
+    return _shift(sliders, direction)
+
+
+def _popcount(bb):
+    """
+    Count the set bits of each bitboard
+    """
+
+    if _HAS_BITWISE_COUNT:
+        return np.bitwise_count(bb).astype(np.int64)
+
+    bits = np.unpackbits(np.ascontiguousarray(bb, dtype="<u8").view(np.uint8))
+    return bits.reshape(-1, 64).sum(axis=1, dtype=np.int64)
+
+
+def _bit_squares(bb):
+    """
+    Get the square of single bit bitboards, with empty bitboards giving -1
+    """
+
+    # frexp gives the exact exponent of a power of two, even above 2^53
+    squares = np.frexp(bb.astype(np.float64))[1] - 1
+    return np.where(bb != 0, squares, -1)
+
+
+def _square_bits(squares):
+    """
+    Get the single bit bitboards of squares, with negative squares giving an empty bitboard
+    """
+
+    bits = U64(1) << np.clip(squares, 0, 63).astype(U64)
+    return np.where(squares >= 0, bits, U64(0))
+
+
+def _pawn_attacks(pawns, is_white):
+    if is_white:
+        return _shift(pawns, NORTH_EAST) | _shift(pawns, NORTH_WEST)
+    return _shift(pawns, SOUTH_EAST) | _shift(pawns, SOUTH_WEST)
+
+
+def _knight_attacks(knights):
+    one_file = ((knights >> U64(1)) & NOT_FILE_H) | ((knights << U64(1)) & NOT_FILE_A)
+    two_files = ((knights >> U64(2)) & NOT_FILE_GH) | ((knights << U64(2)) & NOT_FILE_AB)
+
+    return (
+        (one_file << U64(16))
+        | (one_file >> U64(16))
+        | (two_files << U64(8))
+        | (two_files >> U64(8))
+    )
+
+
+def _king_attacks(kings):
+    attacks = _shift(kings, EAST) | _shift(kings, WEST)
+    row = kings | attacks
+
+    return attacks | (row << U64(8)) | (row >> U64(8))
+
+
+def _attacked_squares(side_bbs, is_white, occupied):
+    """
+    Get every square attacked by one side of a batch, with sliders blocked by `occupied`
+    """
+
+    pawns, knights, bishops, rooks, queens, kings = side_bbs.T
+    empty = ~occupied
+
+    attacked = _pawn_attacks(pawns, is_white) | _knight_attacks(knights) | _king_attacks(kings)
+
+    for direction in DIAGONAL_DIRECTIONS:
+        attacked |= _slide(bishops | queens, empty, direction)
+    for direction in ORTHOGONAL_DIRECTIONS:
+        attacked |= _slide(rooks | queens, empty, direction)
+
+    return attacked
+
+
+def attack_sets(bbs):
+    """
+    Get the squares attacked by white and by black in every position of a batch
+
+    Returns an (N, 2) uint64 array of (white attacks, black attacks)
+    """
+
+    bbs = np.asarray(bbs, dtype=U64)
+    occupied = np.bitwise_or.reduce(bbs, axis=1)
+
+    return np.stack(
+        (
+            _attacked_squares(bbs[:, :6], True, occupied),
+            _attacked_squares(bbs[:, 6:], False, occupied),
+        ),
+        axis=1,
+    )
+
+
+def _king_safe_after(us, them, is_white, occupied, removed):
+    """
+    Check if our king is safe once `occupied` has been changed by a move which didn't move the
+    king, and `removed` holds any enemy pieces it captured
+    """
+
+    king = us[:, 5]
+    empty = ~occupied
+    them_pawns = them[:, 0] & ~removed
+    diagonal = (them[:, 2] | them[:, 4]) & ~removed
+    orthogonal = (them[:, 3] | them[:, 4]) & ~removed
+
+    attackers = (_pawn_attacks(king, is_white) & them_pawns) | (
+        _knight_attacks(king) & them[:, 1] & ~removed
+    )
+    for direction in DIAGONAL_DIRECTIONS:
+        attackers |= _slide(king, empty, direction) & diagonal
+    for direction in ORTHOGONAL_DIRECTIONS:
+        attackers |= _slide(king, empty, direction) & orthogonal
+
+    return attackers == 0
+
+
+def _side_move_groups(us, them, is_white, castling_rights, en_passant_temp_idx):
+    """
+    Find the legal moves of positions which all have the same side to move
+
+    Moves are returned as groups of (row, from squares, target bitboard, kind, delta):
+    - "piece" groups give the from square of each row, and every target is a separate move
+    - "pawn", "double" and "ep" groups are set-wise, each target's from square is `delta` squares
+      behind it
+    - "castle" groups hold the king's destination bit, with `delta` the castling flag
+    """
+
+    rows = np.arange(us.shape[0])
+    us_occ = np.bitwise_or.reduce(us, axis=1)
+    them_occ = np.bitwise_or.reduce(them, axis=1)
+    occupied = us_occ | them_occ
+    empty = ~occupied
+
+    king = us[:, 5]
+    king_square = _bit_squares(king)
+
+    # Lines out of the king: checks, pins and the rays a pinned piece may move along
+    checkers = (_pawn_attacks(king, is_white) & them[:, 0]) | (_knight_attacks(king) & them[:, 1])
+    check_rays = U64(0)
+    pinned = U64(0)
+    pins = []
+
+    for directions, sliders in (
+        (ORTHOGONAL_DIRECTIONS, them[:, 3] | them[:, 4]),
+        (DIAGONAL_DIRECTIONS, them[:, 2] | them[:, 4]),
+    ):
+        for direction in directions:
+            ray = _slide(king, empty, direction)
+            checker = ray & sliders
+            checkers = checkers | checker
+            check_rays = check_rays | np.where(checker != 0, ray, U64(0))
+
+            # Our first piece along the ray, pinned if an enemy slider is next behind it
+            blocker = ray & us_occ
+            beyond = _slide(blocker, empty, direction)
+            pinned_here = np.where(beyond & sliders != 0, blocker, U64(0))
+            pinned = pinned | pinned_here
+            pins.append((pinned_here, ray | beyond))
+
+    num_checkers = _popcount(checkers)
+
+    # Squares a non-king move must land on, nothing at all in double check
+    evasion_mask = np.where(
+        num_checkers == 0,
+        ALL_SQUARES,
+        np.where(num_checkers == 1, checkers | check_rays, U64(0)),
+    )
+
+    def pin_filter(from_bb, step):
+        # Move each piece by `step`, keeping pinned pieces only where they stay on their pin ray
+        targets = _raw_shift(from_bb & ~pinned, step)
+        for pinned_here, pin_ray in pins:
+            targets |= _raw_shift(from_bb & pinned_here, step) & pin_ray
+        return targets
+
+    groups = []
+
+    # King moves, checked against the enemy attack map without our king blocking sliders
+    danger = _attacked_squares(them, not is_white, occupied ^ king)
+    king_targets = _king_attacks(king) & ~us_occ & ~danger
+    groups.append((rows, king_square, king_targets, "piece", 0))
+
+    # Castling, as in `find_king_moves` with the king passing through and landing on safe squares
+    if is_white:
+        kingside_rights = (castling_rights & WK) != 0
+        queenside_rights = (castling_rights & WQ) != 0
+    else:
+        kingside_rights = (castling_rights & BK) != 0
+        queenside_rights = (castling_rights & BQ) != 0
+
+    not_in_check = num_checkers == 0
+    king_file = king_square & 7
+
+    kingside_path = _square_bits(king_square + 1) | _square_bits(king_square + 2)
+    kingside = (
+        kingside_rights
+        & not_in_check
+        & (king_file < 6)
+        & (kingside_path & occupied == 0)
+        & (kingside_path & danger == 0)
+        & (_square_bits(king_square + 3) & us[:, 3] != 0)
+    )
+    destination = _square_bits(king_square + 2)
+    groups.append(
+        (rows[kingside], king_square[kingside], destination[kingside], "castle", KING_CASTLE)
+    )
+
+    queenside_path = _square_bits(king_square - 1) | _square_bits(king_square - 2)
+    queenside = (
+        queenside_rights
+        & not_in_check
+        & (king_file > 2)
+        & ((queenside_path | _square_bits(king_square - 3)) & occupied == 0)
+        & (queenside_path & danger == 0)
+        & (_square_bits(king_square - 4) & us[:, 3] != 0)
+    )
+    destination = _square_bits(king_square - 2)
+    groups.append(
+        (rows[queenside], king_square[queenside], destination[queenside], "castle", QUEEN_CASTLE)
+    )
+
+    # Knights and sliders, one piece of each row at a time
+    piece_targets_mask = ~us_occ & evasion_mask
+    for piece_idx in (1, 2, 3, 4):
+        pieces = us[:, piece_idx].copy()
+
+        while True:
+            has_piece = pieces != 0
+            if not has_piece.any():
+                break
+
+            piece = pieces & (~pieces + U64(1))
+            pieces ^= piece
+            from_squares = _bit_squares(piece)
+
+            if piece_idx == 1:
+                attacks = np.where(has_piece, KNIGHT_TABLE[np.maximum(from_squares, 0)], U64(0))
+            else:
+                attacks = U64(0)
+                if piece_idx in (2, 4):
+                    for direction in DIAGONAL_DIRECTIONS:
+                        attacks = attacks | _slide(piece, empty, direction)
+                if piece_idx in (3, 4):
+                    for direction in ORTHOGONAL_DIRECTIONS:
+                        attacks = attacks | _slide(piece, empty, direction)
+
+            pin_mask = ALL_SQUARES
+            if (piece & pinned != 0).any():
+                pin_mask = np.where(piece & pinned != 0, U64(0), ALL_SQUARES)
+                for pinned_here, pin_ray in pins:
+                    pin_mask = pin_mask | np.where(piece & pinned_here != 0, pin_ray, U64(0))
+
+            targets = attacks & piece_targets_mask & pin_mask
+            groups.append(
+                (rows[has_piece], from_squares[has_piece], targets[has_piece], "piece", 0)
+            )
+
+    # Pawns, set-wise as in `find_pawn_moves`
+    pawns = us[:, 0]
+    if is_white:
+        push, double_rank, left, right = 8, RANK_3, 7, 9
+    else:
+        push, double_rank, left, right = -8, RANK_6, -9, -7
+
+    single_pushers = pawns & _raw_shift(empty, -push)
+    single_targets = pin_filter(single_pushers, push) & evasion_mask
+    groups.append((rows, None, single_targets, "pawn", push))
+
+    double_pushers = single_pushers & _raw_shift(_raw_shift(empty, -push) & double_rank, -push)
+    double_targets = pin_filter(double_pushers, 2 * push) & evasion_mask
+    groups.append((rows, None, double_targets, "double", 2 * push))
+
+    ep_bits = _square_bits(en_passant_temp_idx)
+    ep_captured = _raw_shift(ep_bits, -push)
+
+    for step, wrap_mask in ((left, NOT_FILE_H), (right, NOT_FILE_A)):
+        capture_targets = pin_filter(pawns, step) & wrap_mask
+        groups.append((rows, None, capture_targets & them_occ & evasion_mask, "pawn", step))
+
+        # En passant can uncover a check along the rank, so play it out on the occupancy
+        ep_targets = _raw_shift(pawns, step) & wrap_mask & ep_bits
+        if (ep_targets != 0).any():
+            from_bits = _raw_shift(ep_targets, -step)
+            occupied_after = occupied ^ from_bits ^ ep_targets ^ ep_captured
+            safe = _king_safe_after(us, them, is_white, occupied_after, ep_captured)
+            ep_targets = np.where((ep_targets != 0) & safe, ep_targets, U64(0))
+            groups.append((rows, None, ep_targets, "ep", step))
+
+    return groups, them_occ
+
+
+def _move_groups(bbs, is_whites_move, castling_rights, en_passant_temp_idx):
+    """
+    Split a batch by side to move, and find the move groups of each half with rows relative to
+    the whole batch
+    """
+
+    bbs = np.asarray(bbs, dtype=U64)
+    is_whites_move = np.asarray(is_whites_move, dtype=bool)
+    castling_rights = np.asarray(castling_rights, dtype=np.int64)
+    en_passant_temp_idx = np.asarray(en_passant_temp_idx, dtype=np.int64)
+
+    all_groups = []
+    capture_bbs = np.zeros(bbs.shape[0], dtype=U64)
+
+    for is_white in (True, False):
+        rows = np.flatnonzero(is_whites_move == is_white)
+        if rows.size == 0:
+            continue
+
+        us = bbs[rows, :6] if is_white else bbs[rows, 6:]
+        them = bbs[rows, 6:] if is_white else bbs[rows, :6]
+
+        groups, them_occ = _side_move_groups(
+            us, them, is_white, castling_rights[rows], en_passant_temp_idx[rows]
+        )
+        capture_bbs[rows] = them_occ
+
+        for group_rows, from_squares, targets, kind, delta in groups:
+            all_groups.append((rows[group_rows], from_squares, targets, kind, delta))
+
+    return all_groups, capture_bbs
+
+
+def legal_move_counts(bbs, is_whites_move, castling_rights, en_passant_temp_idx):
+    """
+    Count the legal moves of every position in a batch, without building the moves
+
+    Returns an (N,) int64 array
+    """
+
+    groups, _ = _move_groups(bbs, is_whites_move, castling_rights, en_passant_temp_idx)
+    counts = np.zeros(len(is_whites_move), dtype=np.int64)
+
+    for rows, _, targets, kind, _ in groups:
+        targets = np.broadcast_to(targets, rows.shape)
+        if kind == "pawn":
+            # Each promotion is four moves
+            promotions = _popcount(targets & (RANK_1 | RANK_8))
+            np.add.at(counts, rows, _popcount(targets) + 3 * promotions)
+        else:
+            np.add.at(counts, rows, _popcount(targets))
+
+    return counts
+
+
+def legal_moves(bbs, is_whites_move, castling_rights, en_passant_temp_idx):
+    """
+    Find the legal moves of every position in a batch as packed 16 bit moves
+
+    Returns (rows, moves) arrays ordered by row, so the moves of position i are
+    `moves[rows == i]`, or for all positions at once
+    `np.split(moves, np.searchsorted(rows, np.arange(1, N)))`
+    """
+
+    groups, capture_bbs = _move_groups(bbs, is_whites_move, castling_rights, en_passant_temp_idx)
+
+    all_rows = []
+    all_moves = []
+
+    for rows, from_squares, targets, kind, delta in groups:
+        targets = np.broadcast_to(targets, rows.shape)
+
+        # Expand each target bit into its own entry
+        target_bits = np.unpackbits(
+            np.ascontiguousarray(targets, dtype="<u8").view(np.uint8).reshape(-1, 8),
+            axis=1,
+            bitorder="little",
+        )
+        entry_idx, to_squares = np.nonzero(target_bits)
+        move_rows = rows[entry_idx]
+        to_squares = to_squares.astype(np.int64)
+
+        if kind in ("piece", "castle"):
+            move_from = from_squares[entry_idx]
+        else:
+            move_from = to_squares - delta
+
+        is_capture = ((capture_bbs[move_rows] >> to_squares.astype(U64)) & U64(1)) != 0
+
+        if kind == "castle":
+            flags = np.full(move_rows.shape, delta)
+        elif kind == "double":
+            flags = np.full(move_rows.shape, DOUBLE_PUSH)
+        elif kind == "ep":
+            flags = np.full(move_rows.shape, EP_CAPTURE)
+        else:
+            flags = np.where(is_capture, CAPTURE, QUIET)
+
+        moves = move_from | (to_squares << 6) | (flags << 12)
+
+        if kind == "pawn":
+            # Promotions become one move per promotion piece, knight to queen
+            promoting = (to_squares < 8) | (to_squares >= 56)
+            promo_base = np.where(is_capture, PROMO_CAPTURE_N, PROMO_N)
+            promo_moves = [
+                (move_from | (to_squares << 6) | ((promo_base + piece) << 12))[promoting]
+                for piece in range(4)
+            ]
+
+            all_rows.extend([move_rows[~promoting]] + [move_rows[promoting]] * 4)
+            all_moves.extend([moves[~promoting]] + promo_moves)
+        else:
+            all_rows.append(move_rows)
+            all_moves.append(moves)
+
+    if not all_rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint16)
+
+    rows = np.concatenate(all_rows)
+    moves = np.concatenate(all_moves).astype(np.uint16)
+
+    order = np.argsort(rows, kind="stable")
+    return rows[order], moves[order]
+
+
+def verify_against_reference(fens, depth=2):
+    """
+    Check the batch functions against `find_legal_moves` on every position in the trees of `fens`
+    to `depth`
+
+    Returns the number of positions whose moves didn't match
+    """
+
+    from moves import find_legal_moves, make_move_inplace, unmake_move_inplace
+    from perft import state_from_position
+    from uci import parse_fen
+
+    states = []
+
+    def walk(state, depth):
+        white_bbs, black_bbs = (
+            (state.player_bbs, state.opposition_bbs)
+            if state.is_whites_move
+            else (state.opposition_bbs, state.player_bbs)
+        )
+        reference = find_legal_moves(
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            state.castling_rights,
+            state.en_passant_temp_idx,
+            state.en_passant_real_idx,
+        )
+        states.append(
+            (
+                white_bbs + black_bbs,
+                state.is_whites_move,
+                state.castling_rights,
+                state.en_passant_temp_idx,
+                sorted(reference),
+            )
+        )
+
+        if depth <= 0:
+            return
+
+        for move in reference:
+            undo = make_move_inplace(state, move)
+            walk(state, depth - 1)
+            unmake_move_inplace(state, undo)
+
+    for fen in fens:
+        walk(state_from_position(parse_fen(fen)), depth)
+
+    bbs = np.array([bbs for bbs, *_ in states], dtype=U64)
+    is_whites_move = np.array([entry[1] for entry in states])
+    castling_rights = np.array([entry[2] for entry in states])
+    en_passant_temp_idx = np.array([entry[3] for entry in states])
+
+    counts = legal_move_counts(bbs, is_whites_move, castling_rights, en_passant_temp_idx)
+    rows, moves = legal_moves(bbs, is_whites_move, castling_rights, en_passant_temp_idx)
+    split_moves = np.split(moves, np.searchsorted(rows, np.arange(1, len(states))))
+
+    mismatches = 0
+    for idx, (*_, reference) in enumerate(states):
+        batch_moves = sorted(int(move) for move in split_moves[idx])
+        if batch_moves != reference or counts[idx] != len(reference):
+            mismatches += 1
+
+    return mismatches
+
+
+if __name__ == "__main__":
+    from perft import PERFT_POSITIONS
+
+    fens = [fen for _, fen, _ in PERFT_POSITIONS]
+    print(f"Mismatching positions: {verify_against_reference(fens)}")
@@ -1,19 +1,38 @@
-import math
 import time
 from contextlib import nullcontext
 from dataclasses import dataclass
 
 from book import probe_opening_book
-from evaluation import static_eval
+import evaluation
+from evaluation import MATERIAL_VALUES, material_score, static_eval
 from game import draw_by_insufficient_material
 from profiler import active_profiler, bump_node, profiled
+from move_encoding import (
+    CAPTURE_BIT,
+    FROM_TO_MASK,
+    NULL_MOVE,
+    PROMOTION_BIT,
+    find_matching_move,
+)
 from moves import (
+    GEN_NOISY,
+    GEN_QUIET,
+    SEE_VALUES,
     SearchState,
+    Undo,
+    analyse_king_lines,
     apply_move,
+    attacked_squares,
+    find_evasion_moves,
     find_legal_moves,
+    find_pseudo_legal_moves,
+    get_check_info,
+    is_legal_move,
     is_square_attacked,
     make_move_inplace,
     move_gives_check,
+    pseudo_move_is_legal,
+    see,
     unmake_move_inplace,
 )
 from zobrist import ZobristState, compute_polyglot_key, update_key
@@ -21,29 +40,62 @@ from zobrist import ZobristState, compute_polyglot_key, update_key
 EXACT, LOWER, UPPER = 0, 1, 2
 
 
-@dataclass
+@dataclass(slots=True)
 class TTEntry:
     key: int
-    best_move: tuple
+    best_move: int
     depth: int
     score: int
     node_type: int
     age: int
 
 
-TT = {}
+# Measured size of a stored entry: the slotted entry, its boxed 64-bit key, move and score ints,
+# and its slot in the table (about 184 bytes), rounded up so the table stays within its budget
+TT_ENTRY_BYTES = 192
+TT_BUCKET_SIZE = 4
+DEFAULT_HASH_MB = 16
+MAX_HASH_MB = 1024
+
+# Entries of the same bucket are adjacent, a key's bucket picked by its low bits, and buckets fill
+# from the front
+HASH_MB = DEFAULT_HASH_MB
+TT_BUCKETS = 0
+TT = []
+
+# Search generation, entries stored by earlier searches are replaced first
+TT_AGE = 0
 
 
+# Search pseudo-legal moves, only checking each one is legal right before it is made, so moves
+# after a cutoff never pay for legality checking
+PSEUDO_LEGAL_SEARCH = False
+
 MAX_PLY = 256
-KILLER_MOVES = [[None, None] for _ in range(MAX_PLY)]
+KILLER_MOVES = [[NULL_MOVE, NULL_MOVE] for _ in range(MAX_PLY)]
+
+# Records overwritten by every move made at a ply, so the search allocates nothing per move
+UNDO_STACK = [Undo(0, 0, 0, -1, -1, 0, 0) for _ in range(MAX_PLY)]
+ZOBRIST_STACK = [
+    (ZobristState(True, 0, -1, 0), ZobristState(True, 0, -1, 0)) for _ in range(MAX_PLY)
+]
 
 
 MAX_HISTORY = 16384
-HISTORY = [[[0]*64 for _ in range(64)] for _ in range(2)] # side, from, to
+HISTORY = [[0] * (FROM_TO_MASK + 1) for _ in range(2)]  # side, from | to << 6
 
 
 CHECKMATE_VALUE = 32000
 
+# Bound of every search window, beyond any evaluation or mate score
+INFINITE_SCORE = CHECKMATE_VALUE + 1
+
+# Quiescence skips captures which couldn't raise alpha even winning the victim plus this margin
+DELTA_MARGIN = 200
+
+# Quiescence stands pat on the material balance alone when it is this far outside the window
+LAZY_EVAL_MARGIN = 400
+
 
 MVV_LVV = [
     [16, 15, 14, 13, 12, 11, 10],  # victim P, attacker P, N, B, R, Q, K
@@ -54,8 +106,73 @@ MVV_LVV = [
 ]
 
 
+def set_hash_size(mb):
+    """
+    Resize the transposition table to the largest power of two buckets fitting in `mb` megabytes,
+    clearing it
+    """
+
+    global HASH_MB, TT_BUCKETS, TT, TT_AGE
+
+    HASH_MB = mb
+    buckets = max(mb, 0) * 1024 * 1024 // (TT_ENTRY_BYTES * TT_BUCKET_SIZE)
+    TT_BUCKETS = 1 << (buckets.bit_length() - 1) if buckets > 0 else 1
+    TT = [None] * (TT_BUCKETS * TT_BUCKET_SIZE)
+    TT_AGE = 0
+
+
 def clear_tt():
-    TT.clear()
+    set_hash_size(HASH_MB)
+
+
+def probe_tt(key):
+    """
+    Get the entry stored for `key`, or None if its bucket doesn't hold it
+    """
+
+    start = (key & (TT_BUCKETS - 1)) * TT_BUCKET_SIZE
+    for i in range(start, start + TT_BUCKET_SIZE):
+        entry = TT[i]
+        if entry is None:
+            break
+        if entry.key == key:
+            return entry
+
+    return None
+
+
+def store_tt(key, best_move, depth, score, node_type):
+    """
+    Store a search result in the key's bucket
+
+    An entry for the same key is only overwritten by an exact score, a search at least as deep or a
+    newer search. Otherwise the result replaces an empty slot, or the least valuable entry: the
+    shallowest, counting each search since it was stored as a ply less
+    """
+
+    start = (key & (TT_BUCKETS - 1)) * TT_BUCKET_SIZE
+    replace = start
+    replace_worth = None
+
+    for i in range(start, start + TT_BUCKET_SIZE):
+        entry = TT[i]
+        if entry is None:
+            replace = i
+            break
+
+        if entry.key == key:
+            if node_type == EXACT or depth >= entry.depth or entry.age != TT_AGE:
+                TT[i] = TTEntry(key, best_move, depth, score, node_type, TT_AGE)
+            return
+
+        worth = entry.depth - (TT_AGE - entry.age)
+        if replace_worth is None or worth < replace_worth:
+            replace, replace_worth = i, worth
+
+    TT[replace] = TTEntry(key, best_move, depth, score, node_type, TT_AGE)
+
+
+set_hash_size(HASH_MB)
 
 
 def store_killer_move(ply, move):
@@ -73,7 +190,7 @@ def store_killer_move(ply, move):
 
 
 # @profiled()
-def mvv_lva_ordering(legal_moves, player_bbs, opposition_bbs, en_passant_temp_idx):
+def mvv_lva_ordering(legal_moves, board):
     """
     Sort the legal moves according to the MVV-LVA heuristic:
     - Lookup potential victims of all attacked opponent pieces, most valuable being first
@@ -84,47 +201,22 @@ def mvv_lva_ordering(legal_moves, player_bbs, opposition_bbs, en_passant_temp_id
     - Second array is the unordered non-capturing moves
     """
 
-    def _is_player_pawn(square):
-        return bool((1 << square) & player_bbs[0])
-
-    def _find_bb_idx(square, bbs, end_square=False):
-        for idx, bb in enumerate(bbs):
-            if (1 << square) & bb:
-                return idx
-            # En passant is the only capture move which can attack the en passant square
-            elif end_square and square == en_passant_temp_idx:
-                return 0
-
-        return None
-
     def _find_move_mvv_lva_score(capture_move):
-        victim_square = capture_move[1]
-        aggressor_square = capture_move[0]
+        victim_idx = board[(capture_move >> 6) & 0x3F]
+        aggressor_idx = board[capture_move & 0x3F]
 
-        victim_idx = _find_bb_idx(victim_square, opposition_bbs, True)
-        aggressor_idx = _find_bb_idx(aggressor_square, player_bbs)
+        # En passant is the only capture move which lands on an empty square
+        if victim_idx is None:
+            victim_idx = 0
 
         return MVV_LVV[victim_idx][aggressor_idx]
 
     capture_moves = []
     non_capture_moves = []
 
-    occupied_opposition = (
-        opposition_bbs[0]
-        | opposition_bbs[1]
-        | opposition_bbs[2]
-        | opposition_bbs[3]
-        | opposition_bbs[4]
-        | opposition_bbs[5]
-    )
-
-    # Find all legal capturing moves
+    # Find all legal capturing moves, including en passant
     for move in legal_moves:
-        start_square, end_square, _ = move
-        # Capturing an opponent piece
-        if (1 << end_square) & occupied_opposition:
-            capture_moves.append(move)
-        elif _is_player_pawn(start_square) and end_square == en_passant_temp_idx:
+        if move & CAPTURE_BIT:
             capture_moves.append(move)
         else:
             non_capture_moves.append(move)
@@ -139,16 +231,70 @@ def mvv_lva_ordering(legal_moves, player_bbs, opposition_bbs, en_passant_temp_id
     return capture_moves, non_capture_moves
 
 
+# @profiled()
+def see_ordering(state, capture_moves):
+    """
+    Split captures by static exchange evaluation, keeping their existing (e.g. MVV-LVA) order
+    within each group
+
+    Returns two arrays:
+    - First array is the winning captures followed by the equal ones
+    - Second array is the losing captures
+    """
+
+    board = state.board
+    winning_moves = []
+    equal_moves = []
+    losing_moves = []
+
+    for move in capture_moves:
+        victim_idx = board[(move >> 6) & 0x3F]
+
+        # Taking a more valuable piece wins material whatever the recaptures
+        if victim_idx is not None and SEE_VALUES[victim_idx] > SEE_VALUES[board[move & 0x3F]]:
+            winning_moves.append(move)
+            continue
+
+        score = see(state, move)
+        if score > 0:
+            winning_moves.append(move)
+        elif score == 0:
+            equal_moves.append(move)
+        else:
+            losing_moves.append(move)
+
+    return winning_moves + equal_moves, losing_moves
+
+
+# @profiled()
+def delta_pruning(capture_moves, board, threshold):
+    """
+    Remove captures whose victim is worth no more than `threshold`, i.e. how far the stand pat
+    score (plus a margin) is below alpha. Promotions are always kept
+    """
+
+    pruned_moves = []
+
+    for move in capture_moves:
+        victim_idx = board[(move >> 6) & 0x3F]
+
+        # En passant is the only capture move which lands on an empty square
+        victim_value = MATERIAL_VALUES[0 if victim_idx is None else victim_idx]
+        if victim_value > threshold or move & PROMOTION_BIT:
+            pruned_moves.append(move)
+
+    return pruned_moves
+
+
 def decay_history():
     """
     Decay previously added history values
     """
 
     for s in range(2):
-        for frm in range(64):
-            row = HISTORY[s][frm]
-            for to in range(64):
-                row[to] //= 2
+        row = HISTORY[s]
+        for from_to in range(FROM_TO_MASK + 1):
+            row[from_to] //= 2
 
 
 def clear_history():
@@ -157,10 +303,9 @@ def clear_history():
     """
 
     for s in range(2):
-        for frm in range(64):
-            row = HISTORY[s][frm]
-            for to in range(64):
-                row[to] = 0
+        row = HISTORY[s]
+        for from_to in range(FROM_TO_MASK + 1):
+            row[from_to] = 0
 
 
 def history_side_idx(is_whites_move):
@@ -172,84 +317,201 @@ def history_side_idx(is_whites_move):
 
 
 def add_history(move, depth, side_idx):
-    frm, to, _ = move
+    from_to = move & FROM_TO_MASK
     bonus = depth * depth
-    weight = HISTORY[side_idx][frm][to] + bonus
-    HISTORY[side_idx][frm][to] = min(weight, MAX_HISTORY)
+    weight = HISTORY[side_idx][from_to] + bonus
+    HISTORY[side_idx][from_to] = min(weight, MAX_HISTORY)
 
 
-def order_moves(
-    legal_moves,
-    player_bbs,
-    opposition_bbs,
-    en_passant_temp_idx,
-    pv_move,
-    tt_entry,
-    side_idx,
-    ply,
-):
+class MovePicker:
     """
-    Orders all legal moves in the order they should be searched:
+    Staged move generator, yielding legal moves in the order they should be searched:
     1. PV move
     2. TT move (if distinct)
-    3. Capture moves, ordered by MVV-LVA
-    4. Killer moves
-    5. History moves
-    6. Remaining
-
-    Returns two arrays:
-    - An array of tuples (move, is_quite_move boolean)
-    - An array of all capture moves
+    3. Winning and equal captures by SEE, each ordered by MVV-LVA
+    4. Quiet promotions
+    5. Losing captures
+    6. Killer moves
+    7. Remaining quiet moves, ordered by history
+
+    Each stage is only generated once the previous one has been searched, so a cutoff on an early
+    move skips generating the rest. The PV, TT and killer moves are checked for legality on their
+    own without generating anything. In check, stages only hold the evasions. Otherwise with
+    `PSEUDO_LEGAL_SEARCH`, stages are generated pseudo-legal and each move is checked only when it
+    is about to be yielded.
+
+    Iterating yields tuples (move, is_quiet_move boolean)
     """
 
-    ordered_moves = []
-
-    if pv_move in legal_moves:
-        ordered_moves.append((pv_move, False))  # set this as False for now
-        legal_moves.remove(pv_move)
+    def __init__(self, state, pv_move, tt_move, ply, side_idx, king_lines=None):
+        self.state = state
+        self.pv_move = pv_move
+        self.tt_move = tt_move
+        self.ply = ply
+        self.side_idx = side_idx
+        self.king_lines = king_lines
+        self.attack_map = None
+
+    def _position_args(self):
+        state = self.state
+        return (
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            state.castling_rights,
+            state.en_passant_temp_idx,
+            state.en_passant_real_idx,
+        )
 
-    tt_move = None if tt_entry is None else tt_entry.best_move
-    if tt_move is not None and tt_move in legal_moves:
-        ordered_moves.append((tt_move, False))  # set this as False for now
-        legal_moves.remove(tt_move)
+    def _get_king_lines(self):
+        # Shared by every stage, as the position is the same whenever a stage is generated
+        if self.king_lines is None:
+            state = self.state
+            self.king_lines = analyse_king_lines(
+                state.player_bbs,
+                state.opposition_bbs,
+                state.is_whites_move,
+                (state.player_occ, state.opposition_occ),
+            )
+        return self.king_lines
 
-    capture_moves, non_capture_moves = mvv_lva_ordering(
-        legal_moves, player_bbs, opposition_bbs, en_passant_temp_idx
-    )
-    ordered_moves.extend([(move, False) for move in capture_moves])
+    def _get_attack_map(self):
+        # Squares the opposition attacks, only needed once king moves have to be checked
+        if self.attack_map is None:
+            state = self.state
+            self.attack_map = attacked_squares(
+                state.opposition_bbs,
+                not state.is_whites_move,
+                state.occupied ^ state.player_bbs[5],
+            )
+        return self.attack_map
+
+    def _is_legal(self, move):
+        state = self.state
+        return is_legal_move(
+            move,
+            *self._position_args(),
+            self._get_king_lines(),
+            (state.player_occ, state.opposition_occ),
+            state.board,
+            self._get_attack_map() if state.board[move & 0x3F] == 5 else None,
+        )
 
-    ordered_quiets = quiet_move_ordering(non_capture_moves, ply, side_idx)
-    ordered_moves.extend([(move, True) for move in ordered_quiets])
+    def _is_pseudo_legal(self, move):
+        state = self.state
+        return pseudo_move_is_legal(
+            move,
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            state.en_passant_temp_idx,
+            state.en_passant_real_idx,
+            self._get_king_lines(),
+            self._get_attack_map() if move & 0x3F == self.king_lines[0] else None,
+        )
 
-    return ordered_moves, capture_moves
+    def _generate(self, gen_type):
+        state = self.state
+        king_lines = self._get_king_lines()
+        if king_lines[1]:
+            return find_evasion_moves(
+                state.player_bbs,
+                state.opposition_bbs,
+                state.is_whites_move,
+                state.en_passant_temp_idx,
+                state.en_passant_real_idx,
+                gen_type,
+                king_lines,
+                (state.player_occ, state.opposition_occ),
+                self._get_attack_map(),
+            )
 
+        if PSEUDO_LEGAL_SEARCH:
+            piece_moves, king_moves, castling_moves, pawn_moves = find_pseudo_legal_moves(
+                *self._position_args()[:5], gen_type, (state.player_occ, state.opposition_occ)
+            )
+            return king_moves + piece_moves + pawn_moves + castling_moves
+
+        return find_legal_moves(
+            *self._position_args(),
+            gen_type=gen_type,
+            king_lines=king_lines,
+            occupancies=(state.player_occ, state.opposition_occ),
+            attack_map=self._get_attack_map() if gen_type == GEN_QUIET else self.attack_map,
+        )
 
-def quiet_move_ordering(quiet_moves, ply, side_idx):
-    """
-    Order all quiet moves, killer moves first followed by history moves
+    def __iter__(self):
+        searched = []
+        # Evasions are always generated legal
+        in_check = self._get_king_lines()[1] != 0
+        check_legality = self._is_pseudo_legal if PSEUDO_LEGAL_SEARCH and not in_check else None
+
+        # Hash moves
+        for move in (self.pv_move, self.tt_move):
+            if move and move not in searched and self._is_legal(move):
+                searched.append(move)
+                yield move, False  # set this as False for now
+
+        # Captures and promotions
+        state = self.state
+        noisy_moves = self._generate(GEN_NOISY)
+        capture_moves, promotion_moves = mvv_lva_ordering(noisy_moves, state.board)
+        good_captures, bad_captures = see_ordering(state, capture_moves)
+        for move in good_captures + promotion_moves + bad_captures:
+            if move not in searched and (check_legality is None or check_legality(move)):
+                yield move, False
+
+        if self.ply >= MAX_PLY:
+            return
+
+        # Killer moves
+        for move in KILLER_MOVES[self.ply]:
+            if (
+                move
+                and not move & (CAPTURE_BIT | PROMOTION_BIT)
+                and move not in searched
+                and self._is_legal(move)
+            ):
+                searched.append(move)
+                yield move, True
+
+        # Remaining quiet moves, sorted by history
+        quiet_moves = [move for move in self._generate(GEN_QUIET) if move not in searched]
+        history = HISTORY[self.side_idx]
+        quiet_moves.sort(key=lambda m: history[m & FROM_TO_MASK], reverse=True)
+        for move in quiet_moves:
+            if check_legality is None or check_legality(move):
+                yield move, True
+
+
+def make_move_with_key(state, move, zkey, ply):
     """
+    Make `move` inplace using the ply's undo and zobrist records, and incrementally update `zkey`
 
-    if ply >= MAX_PLY:
-        return []
+    Returns the `Undo` of the move and the child's key
+    """
 
-    killer1, killer2 = KILLER_MOVES[ply]
-    ordered_quiets = []
+    pre_state, post_state = ZOBRIST_STACK[ply]
+    pre_state.is_whites_move = state.is_whites_move
+    pre_state.castling_rights = state.castling_rights
+    pre_state.en_passant_temp_idx = state.en_passant_temp_idx
+    pre_state.player_pawn_bb = state.player_bbs[0]
 
-    # Add killer moves
-    for km in (killer1, killer2):
-        if km is not None and km in quiet_moves and km not in ordered_quiets:
-            ordered_quiets.append(km)
+    undo = make_move_inplace(state, move, UNDO_STACK[ply])
 
-    # Sort the remaining history moves
-    rest = [m for m in quiet_moves if m not in ordered_quiets]
-    rest.sort(key=lambda m: HISTORY[side_idx][m[0]][m[1]], reverse=True)
-    ordered_quiets.extend(rest)
+    post_state.is_whites_move = state.is_whites_move
+    post_state.castling_rights = state.castling_rights
+    post_state.en_passant_temp_idx = state.en_passant_temp_idx
+    post_state.player_pawn_bb = state.player_bbs[0]
+    post_state.moving_piece_idx = undo.moved_piece_idx
+    post_state.captured_piece_idx = undo.captured_piece_idx
+    post_state.captured_square_idx = undo.captured_piece_square
 
-    return ordered_quiets
+    return undo, update_key(zkey, move, pre_state, post_state)
 
 
 # @profiled()
-def can_do_lmr(state, move, depth, in_check, capture_moves, ply):
+def can_do_lmr(state, move, depth, in_check, ply, check_info=None):
     """
     Check if the provided conditions allow for LMR to be applied
 
@@ -264,8 +526,7 @@ def can_do_lmr(state, move, depth, in_check, capture_moves, ply):
     if depth < 3 or in_check:
         return False
 
-    _, _, promotion = move
-    if promotion is not None or move in capture_moves:
+    if move & (PROMOTION_BIT | CAPTURE_BIT):
         return False
 
     if move in KILLER_MOVES[ply]:
@@ -278,6 +539,8 @@ def can_do_lmr(state, move, depth, in_check, capture_moves, ply):
         state.is_whites_move,
         state.en_passant_temp_idx,
         state.en_passant_real_idx,
+        state.board,
+        check_info,
     ):
         return False
 
@@ -287,39 +550,58 @@ def can_do_lmr(state, move, depth, in_check, capture_moves, ply):
 # @profiled(root_only=True)
 def quiescence_search(
     state: SearchState,
-    legal_moves,
     alpha,
     beta,
     qdepth=6,
     ply=0,
     deadline=None,
+    zkey=None,
 ):
     """
     Perform a quiescence search on the provided position
+
+    `zkey` is the position's zobrist key, used to cache static evaluations if given
+
+    Moves are only generated once they are needed: every evasion when in check, otherwise only
+    captures and promotions after standing pat has failed to cut off. Captures which lose material
+    by SEE, or which can't raise alpha even winning their victim (delta pruning), are skipped.
+    The full static evaluation is also skipped when the material balance alone is far outside the
+    window
     """
     bump_node("q")
 
-    def _quiesce_child(moves, best_value, alpha, beta):
-        for move in moves:
-            undo = make_move_inplace(state, move)
+    def _quiesce_child(moves, best_value, alpha, beta, king_lines=None):
+        # Keys are only followed while the evaluation cache can use them
+        track_key = zkey is not None and evaluation.EVAL_CACHE_SIZE and ply < MAX_PLY
+        undo_slot = UNDO_STACK[ply] if ply < MAX_PLY else None
+        child_key = None
 
-            new_legal_moves = find_legal_moves(
+        for move in moves:
+            # Pseudo-legal moves are only checked once they are about to be made
+            if king_lines is not None and not pseudo_move_is_legal(
+                move,
                 state.player_bbs,
                 state.opposition_bbs,
                 state.is_whites_move,
-                state.castling_rights,
                 state.en_passant_temp_idx,
                 state.en_passant_real_idx,
-            )
+                king_lines,
+            ):
+                continue
+
+            if track_key:
+                undo, child_key = make_move_with_key(state, move, zkey, ply)
+            else:
+                undo = make_move_inplace(state, move, undo_slot)
 
             score, completed = quiescence_search(
                 state,
-                new_legal_moves,
                 -beta,
                 -alpha,
                 qdepth - 1,
                 ply + 1,
                 deadline,
+                child_key,
             )
             score = -score
 
@@ -340,33 +622,57 @@ def quiescence_search(
     if deadline is not None and time.monotonic() >= deadline:
         return 0, False
 
-    # No legal moves, so a mate has occurred
     king_square = state.player_bbs[5].bit_length() - 1
     in_check = is_square_attacked(
-        king_square, state.opposition_bbs, state.player_bbs, not state.is_whites_move
+        king_square, state.opposition_bbs, state.player_bbs, not state.is_whites_move, state.occupied
     )
 
-    if not legal_moves:
-        if in_check:
-            return -CHECKMATE_VALUE + ply, True
-
-        return 0, True  # stalemate
-
-    static_evaluation = static_eval(state.player_bbs, state.opposition_bbs, state.is_whites_move)
-    best_value = static_evaluation
-
     # Ensure player is not in check as you cannot stand pat in such case
     if in_check:
-        # Search the "best" evading move first
-        capture_moves, non_capture_moves = mvv_lva_ordering(
-            legal_moves, state.player_bbs, state.opposition_bbs, state.en_passant_temp_idx
+        evasion_moves = find_evasion_moves(
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            state.en_passant_temp_idx,
+            state.en_passant_real_idx,
+            occupancies=(state.player_occ, state.opposition_occ),
         )
 
+        # No legal moves while in check, so a mate has occurred
+        if not evasion_moves:
+            return -CHECKMATE_VALUE + ply, True
+
+        # Search the "best" evading move first
+        capture_moves, non_capture_moves = mvv_lva_ordering(evasion_moves, state.board)
+
         # Keep searching if king is in check - ignore qdepth here
         # Set best_value to -infinity as that ensures best score comes from an evasion move, not static eval
-        best_value = -math.inf
+        best_value = -INFINITE_SCORE
         return _quiesce_child(capture_moves + non_capture_moves, best_value, alpha, beta)
 
+    # Lazy evaluation: stand pat on a bound from the material balance if the positional terms
+    # couldn't bring it back inside the window
+    material = state.material if state.is_whites_move else -state.material
+    if evaluation.DEBUG_INCREMENTAL_EVAL:
+        white_bbs = state.player_bbs if state.is_whites_move else state.opposition_bbs
+        black_bbs = state.opposition_bbs if state.is_whites_move else state.player_bbs
+        expected = material_score(white_bbs, black_bbs)
+        assert state.material == expected, f"incremental material {state.material} != {expected}"
+
+    if material - LAZY_EVAL_MARGIN >= beta:
+        best_value = material - LAZY_EVAL_MARGIN
+    elif material + LAZY_EVAL_MARGIN <= alpha:
+        best_value = material + LAZY_EVAL_MARGIN
+    else:
+        best_value = static_eval(
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            (state.mg_score, state.eg_score, state.phase),
+            zkey,
+            state.pawn_key,
+        )
+
     if qdepth <= 0:
         return best_value, True
 
@@ -377,11 +683,45 @@ def quiescence_search(
     if best_value > alpha:
         alpha = best_value
 
-    capture_moves, _ = mvv_lva_ordering(
-        legal_moves, state.player_bbs, state.opposition_bbs, state.en_passant_temp_idx
+    if PSEUDO_LEGAL_SEARCH:
+        piece_moves, king_moves, _, pawn_moves = find_pseudo_legal_moves(
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            state.castling_rights,
+            state.en_passant_temp_idx,
+            GEN_NOISY,
+            (state.player_occ, state.opposition_occ),
+        )
+        capture_moves, promotion_moves = mvv_lva_ordering(
+            king_moves + piece_moves + pawn_moves, state.board
+        )
+        capture_moves = delta_pruning(capture_moves, state.board, alpha - best_value - DELTA_MARGIN)
+        capture_moves, _ = see_ordering(state, capture_moves)
+        king_lines = analyse_king_lines(
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            (state.player_occ, state.opposition_occ),
+        )
+
+        return _quiesce_child(capture_moves + promotion_moves, best_value, alpha, beta, king_lines)
+
+    noisy_moves = find_legal_moves(
+        state.player_bbs,
+        state.opposition_bbs,
+        state.is_whites_move,
+        state.castling_rights,
+        state.en_passant_temp_idx,
+        state.en_passant_real_idx,
+        gen_type=GEN_NOISY,
+        occupancies=(state.player_occ, state.opposition_occ),
     )
+    capture_moves, promotion_moves = mvv_lva_ordering(noisy_moves, state.board)
+    capture_moves = delta_pruning(capture_moves, state.board, alpha - best_value - DELTA_MARGIN)
+    capture_moves, _ = see_ordering(state, capture_moves)
 
-    return _quiesce_child(capture_moves, best_value, alpha, beta)
+    return _quiesce_child(capture_moves + promotion_moves, best_value, alpha, beta)
 
 
 # @profiled(root_only=True)
@@ -392,7 +732,7 @@ def negamax(
     zkey,
     ply=0,
     depth=3,
-    pv_move=None,
+    pv_move=NULL_MOVE,
     deadline=None,
 ):
     """
@@ -401,26 +741,7 @@ def negamax(
     bump_node("negamax")
 
     def _search_child(move, child_alpha, child_beta, child_depth):
-        pre_state = ZobristState(
-            state.is_whites_move,
-            state.castling_rights,
-            state.en_passant_temp_idx,
-            state.player_bbs[0],
-        )
-
-        undo = make_move_inplace(state, move)
-
-        post_state = ZobristState(
-            state.is_whites_move,
-            state.castling_rights,
-            state.en_passant_temp_idx,
-            state.player_bbs[0],
-            undo.moved_piece_idx,
-            undo.captured_piece_idx,
-            undo.captured_piece_square,
-        )
-
-        child_key = update_key(zkey, move, pre_state, post_state)
+        undo, child_key = make_move_with_key(state, move, zkey, ply)
 
         child_score, _, completed = negamax(
             state,
@@ -429,7 +750,7 @@ def negamax(
             child_key,
             ply + 1,
             child_depth,
-            None,
+            NULL_MOVE,
             deadline,
         )
 
@@ -444,30 +765,27 @@ def negamax(
         return abs(s) >= CHECKMATE_VALUE - 1000
 
     def _store_tt(score, move, node_type):
-        old = TT.get(zkey)
-        if old is None or depth >= old.depth:
-            # Normalise mating ply depth
-            tt_score = score
-            if _is_mate_score(tt_score):
-                tt_score = tt_score + ply if tt_score > 0 else tt_score - ply
+        # Normalise mating ply depth
+        if _is_mate_score(score):
+            score = score + ply if score > 0 else score - ply
 
-            TT[zkey] = TTEntry(zkey, move, depth, tt_score, node_type, state.halfmove_clock)
+        store_tt(zkey, move, depth, score, node_type)
 
     if deadline is not None and time.monotonic() >= deadline:
-        return 0, (), False
+        return 0, NULL_MOVE, False
 
     if draw_by_insufficient_material(state.player_bbs, state.opposition_bbs):
-        return 0, (), True
+        return 0, NULL_MOVE, True
 
     # Draw by 50-move rule
     if state.halfmove_clock >= 100:
-        return 0, (), True
+        return 0, NULL_MOVE, True
 
     alpha_orig = alpha
     beta_orig = beta
 
     # Check transposition table
-    entry = TT.get(zkey)
+    entry = probe_tt(zkey)
     if entry is not None and entry.depth >= depth:
         # Keep mate distance consistent across different depths
         score = entry.score
@@ -483,61 +801,52 @@ def negamax(
         if alpha >= beta:
             return score, entry.best_move, True
 
-    legal_moves = find_legal_moves(
-        state.player_bbs,
-        state.opposition_bbs,
-        state.is_whites_move,
-        state.castling_rights,
-        state.en_passant_temp_idx,
-        state.en_passant_real_idx,
-    )
-
-    # No legal moves, so a mate has occurred
-    king_square = state.player_bbs[5].bit_length() - 1
-    in_check = is_square_attacked(
-        king_square, state.opposition_bbs, state.player_bbs, not state.is_whites_move
-    )
-    if not legal_moves:
-        if in_check:
-            return -CHECKMATE_VALUE + ply, (), True
-
-        return 0, (), True  # stalemate
-
     if depth <= 0:
         q_score, q_completed = quiescence_search(
             state,
-            legal_moves,
             alpha,
             beta,
             ply=ply,
             deadline=deadline,
+            zkey=zkey,
         )
         if q_completed:
-            return q_score, (), True
+            return q_score, NULL_MOVE, True
         else:
-            return 0, (), False
-
-    best_move = ()
-    best_score = -math.inf
+            return 0, NULL_MOVE, False
 
-    side_idx = history_side_idx(state.is_whites_move)
-    ordered_moves, capture_moves = order_moves(
-        legal_moves[:],
+    # Checkers come from the king line analysis, which the move picker reuses for legality
+    king_lines = analyse_king_lines(
         state.player_bbs,
         state.opposition_bbs,
-        state.en_passant_temp_idx,
-        pv_move,
-        entry,
-        side_idx,
-        ply,
+        state.is_whites_move,
+        (state.player_occ, state.opposition_occ),
     )
+    in_check = king_lines[1] != 0
+
+    # Only needed to find quiet checks for LMR, which never happens in check or at low depth
+    check_info = None
+    if depth >= 3 and not in_check:
+        check_info = get_check_info(
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            (state.player_occ, state.opposition_occ),
+        )
+
+    best_move = NULL_MOVE
+    best_score = -INFINITE_SCORE
+
+    side_idx = history_side_idx(state.is_whites_move)
+    tt_move = NULL_MOVE if entry is None else entry.best_move
+    move_picker = MovePicker(state, pv_move, tt_move, ply, side_idx, king_lines)
 
-    for idx, (move, is_quiet_move) in enumerate(ordered_moves):
+    for idx, (move, is_quiet_move) in enumerate(move_picker):
         # The PV move always gets searched at full depth
         if idx == 0:
             score, completed = _search_child(move, -beta, -alpha, depth - 1)
         else:
-            if can_do_lmr(state, move, depth, in_check, capture_moves, ply):
+            if can_do_lmr(state, move, depth, in_check, ply, check_info):
                 # Calculate search depth reduction
                 reduction = 1
                 if idx > 12:
@@ -576,6 +885,13 @@ def negamax(
             _store_tt(best_score, best_move, LOWER)
             return best_score, best_move, True
 
+    # No legal moves, so a mate has occurred
+    if best_move == NULL_MOVE:
+        if in_check:
+            return -CHECKMATE_VALUE + ply, NULL_MOVE, True
+
+        return 0, NULL_MOVE, True  # stalemate
+
     # Set values for transposition table
     if best_score <= alpha_orig:
         node_type = UPPER
@@ -605,15 +921,16 @@ def evaluate_position(
     Returns an evaluation of the the specified board position from the
     point of view of white, as well as the best move
     """
-    global KILLER_MOVES
+    global KILLER_MOVES, TT_AGE
 
     player_bbs = white_bbs if is_whites_move else black_bbs
     opposition_bbs = black_bbs if is_whites_move else white_bbs
 
-    best_move = ()
+    best_move = NULL_MOVE
     best_eval = 0
-    KILLER_MOVES = [[None, None] for _ in range(MAX_PLY)]
+    KILLER_MOVES = [[NULL_MOVE, NULL_MOVE] for _ in range(MAX_PLY)]
     decay_history()
+    TT_AGE += 1
 
     max_depth = 0
 
@@ -630,7 +947,9 @@ def evaluate_position(
             en_passant_temp_idx,
             en_passant_real_idx,
         )
-        if book_move in legal_moves:
+        # Book moves come as (start, end, promotion) tuples, so find the matching packed move
+        book_move = find_matching_move(legal_moves, *book_move)
+        if book_move is not None:
             return 0, book_move, 0
 
     # Compute zobrist key for current position
@@ -656,8 +975,8 @@ def evaluate_position(
         with profiler_context:
             eval_d, move_d, completed_d = negamax(
                 state,
-                alpha=-math.inf,
-                beta=math.inf,
+                alpha=-INFINITE_SCORE,
+                beta=INFINITE_SCORE,
                 zkey=zkey,
                 depth=d,
                 pv_move=best_move,
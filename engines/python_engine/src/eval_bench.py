@@ -0,0 +1,111 @@
+import argparse
+import timeit
+
+from evaluation import EG_VALUES, MG_VALUES, eg_bbs, mg_bbs, pesto_scores, phase_inc
+from moves import find_legal_moves, make_move_inplace, unmake_move_inplace
+from perft import PERFT_POSITIONS, state_from_position
+from uci import parse_fen
+
+
+def nested_pesto_scores(white_bbs, black_bbs):
+    """
+    Sum the piece-square tables the way `pesto_scores` did before the flat tables, looking up the
+    nested table and material separately and flipping white's squares for every piece
+    """
+
+    mg_eval = 0
+    eg_eval = 0
+    game_phase = 0
+
+    for idx, bb in enumerate(white_bbs):
+        while bb:
+            lsb = bb & -bb
+            square = (lsb.bit_length() - 1) ^ 56
+
+            mg_eval += mg_bbs[idx][square] + MG_VALUES.get(idx, 0)
+            eg_eval += eg_bbs[idx][square] + EG_VALUES.get(idx, 0)
+            game_phase += phase_inc.get(idx, 0)
+
+            bb ^= lsb
+
+    for idx, bb in enumerate(black_bbs):
+        while bb:
+            lsb = bb & -bb
+            square = lsb.bit_length() - 1
+
+            mg_eval -= mg_bbs[idx][square] + MG_VALUES.get(idx, 0)
+            eg_eval -= eg_bbs[idx][square] + EG_VALUES.get(idx, 0)
+            game_phase += phase_inc.get(idx, 0)
+
+            bb ^= lsb
+
+    return mg_eval, eg_eval, game_phase
+
+
+def collect_positions(depth):
+    """
+    List the (white bitboards, black bitboards) of every position in the reference perft trees to
+    `depth`
+    """
+
+    positions = []
+
+    def walk(state, depth):
+        if state.is_whites_move:
+            positions.append((state.player_bbs[:], state.opposition_bbs[:]))
+        else:
+            positions.append((state.opposition_bbs[:], state.player_bbs[:]))
+
+        if depth == 0:
+            return
+
+        for move in find_legal_moves(
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            state.castling_rights,
+            state.en_passant_temp_idx,
+            state.en_passant_real_idx,
+        ):
+            undo = make_move_inplace(state, move)
+            walk(state, depth - 1)
+            unmake_move_inplace(state, undo)
+
+    for _, fen, _ in PERFT_POSITIONS:
+        walk(state_from_position(parse_fen(fen)), depth)
+
+    return positions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the flat piece-square tables against the nested tables they replaced"
+    )
+    parser.add_argument("depth", type=int, nargs="?", default=2)
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs, the best is reported")
+    args = parser.parse_args()
+
+    positions = collect_positions(args.depth)
+
+    for white_bbs, black_bbs in positions:
+        assert pesto_scores(white_bbs, black_bbs) == nested_pesto_scores(white_bbs, black_bbs)
+
+    print(f"Positions: {len(positions)}")
+
+    timings = {}
+    for name, scores in (("nested", nested_pesto_scores), ("flat", pesto_scores)):
+        timings[name] = min(
+            timeit.repeat(
+                lambda: [scores(white_bbs, black_bbs) for white_bbs, black_bbs in positions],
+                number=1,
+                repeat=args.repeat,
+            )
+        )
+        per_call = timings[name] / len(positions) * 1e6
+        print(f"{name:>6}: {timings[name]:.3f}s ({per_call:.2f}us per position)")
+
+    print(f"Speedup: {timings['nested'] / timings['flat']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,9 @@
+from dataclasses import dataclass
+
+from attacks import ALL_SQUARES, FILE_A, pawn_attacks_bb
+from profiler import bump_eval_cache
+from zobrist import compute_pawn_key
+
 MG_VALUES = {
     0: 82,  # pawn
     1: 337,  # knight
@@ -165,54 +171,347 @@ phase_inc = {
 }
 
 
-def pesto_evaluation(white_bbs, black_bbs):
+def _flat_tables(tables, values):
     """
-    Evaluate the current position using opening/middlegame and endgame piece-square tables,
-    interpolating between the two based on the remaining material
+    Build a flat piece-square table with material folded in, indexed by
+    `PST_OFFSETS[is_white] + 64 * piece_idx + square`
+
+    White's half has the board flip applied, and black's half is negated so every score is from
+    white's point of view
+    """
+
+    white_half = [
+        table[square ^ 56] + values.get(piece_idx, 0)
+        for piece_idx, table in enumerate(tables)
+        for square in range(64)
+    ]
+    black_half = [
+        -table[square] - values.get(piece_idx, 0)
+        for piece_idx, table in enumerate(tables)
+        for square in range(64)
+    ]
+
+    return tuple(white_half + black_half)
+
+
+# Offset of each colour's half of the flat tables, indexed by is_white
+PST_OFFSETS = (384, 0)
+
+MG_PST = _flat_tables(mg_bbs, MG_VALUES)
+EG_PST = _flat_tables(eg_bbs, EG_VALUES)
+PHASE_INC = tuple(phase_inc.get(piece_idx, 0) for piece_idx in range(6))
+
+# Plain piece values for quick material estimates, by bitboard index
+MATERIAL_VALUES = (100, 320, 330, 500, 900, 0)
+
+
+def material_score(white_bbs, black_bbs):
+    """
+    Count the material balance from white's point of view
+    """
+
+    return sum(
+        (white_bb.bit_count() - black_bb.bit_count()) * value
+        for white_bb, black_bb, value in zip(white_bbs, black_bbs, MATERIAL_VALUES)
+    )
+
+
+# Check the incremental scores passed to `static_eval`, and the material balance quiescence stands
+# pat on, against a full recompute, for debugging
+DEBUG_INCREMENTAL_EVAL = False
+
+# Direct-mapped cache of static evaluations by zobrist key, a power of two set with
+# `set_eval_cache_size` or the UCI EvalCache option. Off by default, as the incremental scores
+# already make a miss cheaper than following keys through quiescence
+EVAL_CACHE_SIZE = 0
+MAX_EVAL_CACHE_SIZE = 1 << 22
+_eval_cache_keys = [None] * EVAL_CACHE_SIZE
+_eval_cache_values = [0] * EVAL_CACHE_SIZE
+
+
+def set_eval_cache_size(entries):
+    """
+    Resize the evaluation cache to the largest power of two not above `entries`, clearing it
+    """
+
+    global EVAL_CACHE_SIZE, _eval_cache_keys, _eval_cache_values
+
+    EVAL_CACHE_SIZE = 1 << (entries.bit_length() - 1) if entries > 0 else 0
+    _eval_cache_keys = [None] * EVAL_CACHE_SIZE
+    _eval_cache_values = [0] * EVAL_CACHE_SIZE
+
+
+def clear_eval_cache():
+    set_eval_cache_size(EVAL_CACHE_SIZE)
+
+
+def pesto_scores(white_bbs, black_bbs):
+    """
+    Sum the piece-square tables over every piece
+
+    Returns the midgame score, endgame score and game phase, the scores from white's point of view
     """
 
     mg_eval = 0
     eg_eval = 0
     game_phase = 0
 
-    for idx, bb in enumerate(white_bbs):
-        while bb:
-            lsb = bb & -bb
-            square = (lsb.bit_length() - 1) ^ 56
+    for offset, bbs in ((PST_OFFSETS[True], white_bbs), (PST_OFFSETS[False], black_bbs)):
+        for idx, bb in enumerate(bbs):
+            base = offset + 64 * idx
+            while bb:
+                lsb = bb & -bb
+                pst_idx = base + lsb.bit_length() - 1
 
-            mg_eval += mg_bbs[idx][square] + MG_VALUES.get(idx, 0)
-            eg_eval += eg_bbs[idx][square] + EG_VALUES.get(idx, 0)
-            game_phase += phase_inc.get(idx, 0)
+                mg_eval += MG_PST[pst_idx]
+                eg_eval += EG_PST[pst_idx]
+                game_phase += PHASE_INC[idx]
 
-            bb ^= lsb
+                bb ^= lsb
 
-    for idx, bb in enumerate(black_bbs):
-        while bb:
-            lsb = bb & -bb
-            square = lsb.bit_length() - 1
+    return mg_eval, eg_eval, game_phase
 
-            mg_eval -= mg_bbs[idx][square] + MG_VALUES.get(idx, 0)
-            eg_eval -= eg_bbs[idx][square] + EG_VALUES.get(idx, 0)
-            game_phase += phase_inc.get(idx, 0)
 
-            bb ^= lsb
+def taper(mg_eval, eg_eval, game_phase):
+    """
+    Interpolate between the midgame and endgame scores based on the game phase, in whole
+    centipawns rounded towards zero so a position and its colour-flipped mirror score the same
+    """
 
-    # tapered eval
     mg_phase = game_phase
     if mg_phase > 24:
         mg_phase = 24  # in case of early promotion
     eg_phase = 24 - mg_phase
 
-    return (mg_eval * mg_phase + eg_eval * eg_phase) / 24
+    weighted = mg_eval * mg_phase + eg_eval * eg_phase
+    return weighted // 24 if weighted >= 0 else -(-weighted // 24)
+
+
+def pesto_evaluation(white_bbs, black_bbs):
+    """
+    Evaluate the current position using opening/middlegame and endgame piece-square tables,
+    interpolating between the two based on the remaining material
+    """
+
+    return taper(*pesto_scores(white_bbs, black_bbs))
 
 
-def static_eval(player_bbs, opposition_bbs, is_whites_move):
+# Rows of bitboards unpacked at a time by `batch_pesto_evaluation`, bounding its memory use
+BATCH_EVAL_CHUNK_SIZE = 4096
+
+
+def batch_pesto_evaluation(bbs):
+    """
+    Evaluate many positions at once, matching `pesto_evaluation` exactly
+
+    `bbs` is an (N, 12) uint64 array of the white pawn, knight, bishop, rook, queen and king
+    bitboards followed by black's. Each bitboard is unpacked into 64 one-hot squares, laid out the
+    same as the flat tables, so every score is a dot product with a table
+
+    Returns (midgame, endgame, phase, tapered) arrays of length N, from white's point of view
+    """
+
+    # Imported here so the search never loads numpy
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise ImportError("batch_pesto_evaluation requires numpy") from e
+
+    bbs = np.ascontiguousarray(bbs, dtype="<u8").reshape(-1, 12)
+
+    # Tables stacked as columns, the sums stay exact well within float64's integer range
+    phase_table = [PHASE_INC[(pst_idx >> 6) % 6] for pst_idx in range(768)]
+    weights = np.array([MG_PST, EG_PST, phase_table], dtype=np.float64).T
+
+    sums = np.empty((bbs.shape[0], 3), dtype=np.int64)
+    for start in range(0, bbs.shape[0], BATCH_EVAL_CHUNK_SIZE):
+        chunk = bbs[start : start + BATCH_EVAL_CHUNK_SIZE]
+        planes = np.unpackbits(chunk.view(np.uint8), axis=1, bitorder="little")
+        sums[start : start + BATCH_EVAL_CHUNK_SIZE] = planes.astype(np.float64) @ weights
+
+    mg_eval, eg_eval, game_phase = sums.T
+    mg_phase = np.minimum(game_phase, 24)  # in case of early promotion
+    weighted = mg_eval * mg_phase + eg_eval * (24 - mg_phase)
+    tapered = np.sign(weighted) * (np.abs(weighted) // 24)
+
+    return mg_eval, eg_eval, game_phase, tapered
+
+
+# Pawn structure penalties per pawn, and passed pawn bonuses by rank from the pawn's own side
+DOUBLED_PAWN_MG, DOUBLED_PAWN_EG = -10, -20
+ISOLATED_PAWN_MG, ISOLATED_PAWN_EG = -10, -15
+PASSED_PAWN_MG = (0, 5, 10, 15, 25, 40, 60, 0)
+PASSED_PAWN_EG = (0, 10, 15, 25, 40, 65, 100, 0)
+
+FILES = tuple(FILE_A << file for file in range(8))
+ADJACENT_FILES = tuple(
+    (FILES[file - 1] if file > 0 else 0) | (FILES[file + 1] if file < 7 else 0)
+    for file in range(8)
+)
+
+
+def _north_fill(bb):
+    bb |= bb << 8
+    bb |= bb << 16
+    bb |= bb << 32
+    return bb & ALL_SQUARES
+
+
+def _south_fill(bb):
+    bb |= bb >> 8
+    bb |= bb >> 16
+    bb |= bb >> 32
+    return bb
+
+
+@dataclass(slots=True)
+class PawnEntry:
+    key: int
+    mg_score: int  # from white's point of view
+    eg_score: int
+    white_attacks: int
+    black_attacks: int
+    white_attack_spans: int  # every square a white pawn could attack as it advances
+    black_attack_spans: int
+
+
+def evaluate_pawns(white_pawn_bb, black_pawn_bb, key=0):
+    """
+    Score doubled, isolated and passed pawns, and find the squares each side's pawns attack now and
+    could attack as they advance
+    """
+
+    white_attacks = pawn_attacks_bb(white_pawn_bb, True)
+    black_attacks = pawn_attacks_bb(black_pawn_bb, False)
+    white_attack_spans = _north_fill(white_attacks)
+    black_attack_spans = _south_fill(black_attacks)
+
+    # Squares a pawn must pass, and which enemy pawns could stop it on the way
+    white_front_spans = _north_fill(white_pawn_bb << 8)
+    black_front_spans = _south_fill(black_pawn_bb >> 8)
+    white_stoppers = black_front_spans | black_attack_spans
+    black_stoppers = white_front_spans | white_attack_spans
+
+    mg_score = 0
+    eg_score = 0
+
+    for pawn_bb, other_pawn_bb, own_front, stoppers, sign in (
+        (white_pawn_bb, black_pawn_bb, white_front_spans, white_stoppers, 1),
+        (black_pawn_bb, white_pawn_bb, black_front_spans, black_stoppers, -1),
+    ):
+        for file in range(8):
+            count = (pawn_bb & FILES[file]).bit_count()
+            if count > 1:
+                mg_score += sign * DOUBLED_PAWN_MG * (count - 1)
+                eg_score += sign * DOUBLED_PAWN_EG * (count - 1)
+            if count and not pawn_bb & ADJACENT_FILES[file]:
+                mg_score += sign * ISOLATED_PAWN_MG * count
+                eg_score += sign * ISOLATED_PAWN_EG * count
+
+        # Frontmost pawns which no enemy pawn can block or capture
+        passed = pawn_bb & ~stoppers & ~own_front
+        while passed:
+            lsb = passed & -passed
+            rank = (lsb.bit_length() - 1) >> 3
+            if sign < 0:
+                rank = 7 - rank
+
+            mg_score += sign * PASSED_PAWN_MG[rank]
+            eg_score += sign * PASSED_PAWN_EG[rank]
+
+            passed ^= lsb
+
+    return PawnEntry(
+        key,
+        mg_score,
+        eg_score,
+        white_attacks,
+        black_attacks,
+        white_attack_spans,
+        black_attack_spans,
+    )
+
+
+# Direct-mapped cache of pawn structure evaluations by pawn key, a power of two set with
+# `set_pawn_hash_size`
+PAWN_HASH_SIZE = 1 << 14
+_pawn_hash = [None] * PAWN_HASH_SIZE
+
+
+def set_pawn_hash_size(entries):
+    """
+    Resize the pawn hash table to the largest power of two not above `entries`, clearing it
+    """
+
+    global PAWN_HASH_SIZE, _pawn_hash
+
+    PAWN_HASH_SIZE = 1 << (entries.bit_length() - 1) if entries > 0 else 0
+    _pawn_hash = [None] * PAWN_HASH_SIZE
+
+
+def clear_pawn_hash():
+    set_pawn_hash_size(PAWN_HASH_SIZE)
+
+
+def probe_pawns(white_pawn_bb, black_pawn_bb, pawn_key=None):
+    """
+    Get the `PawnEntry` of a pawn structure from the pawn hash table, evaluating and storing it on a
+    miss
+
+    `pawn_key` is the structure's pawn key if already known, e.g. from a `SearchState`
+    """
+
+    if not PAWN_HASH_SIZE:
+        return evaluate_pawns(white_pawn_bb, black_pawn_bb)
+
+    if pawn_key is None:
+        pawn_key = compute_pawn_key(white_pawn_bb, black_pawn_bb)
+    elif DEBUG_INCREMENTAL_EVAL:
+        expected = compute_pawn_key(white_pawn_bb, black_pawn_bb)
+        assert pawn_key == expected, f"incremental pawn key {pawn_key} != recomputed {expected}"
+
+    slot = pawn_key & (PAWN_HASH_SIZE - 1)
+    entry = _pawn_hash[slot]
+    if entry is None or entry.key != pawn_key:
+        entry = evaluate_pawns(white_pawn_bb, black_pawn_bb, pawn_key)
+        _pawn_hash[slot] = entry
+
+    return entry
+
+
+def static_eval(player_bbs, opposition_bbs, is_whites_move, scores=None, key=None, pawn_key=None):
     """
     Return an evaluation relative to the player provided
+
+    `scores` can be passed in as the (midgame, endgame, phase) tuple kept up to date by make/unmake,
+    and `pawn_key` as the pawn key, which leaves only a pawn hash probe and the tapering to do. With
+    the position's zobrist `key`, the evaluation is looked up in and stored to the evaluation cache
     """
 
+    if key is not None and EVAL_CACHE_SIZE:
+        slot = key & (EVAL_CACHE_SIZE - 1)
+        if _eval_cache_keys[slot] == key:
+            bump_eval_cache(True)
+            return _eval_cache_values[slot]
+        bump_eval_cache(False)
+
     white_bbs = player_bbs if is_whites_move else opposition_bbs
     black_bbs = opposition_bbs if is_whites_move else player_bbs
-    score_white_pov = pesto_evaluation(white_bbs, black_bbs)
 
-    return score_white_pov if is_whites_move else -score_white_pov
+    if scores is None:
+        scores = pesto_scores(white_bbs, black_bbs)
+    elif DEBUG_INCREMENTAL_EVAL:
+        expected = pesto_scores(white_bbs, black_bbs)
+        assert scores == expected, f"incremental scores {scores} != recomputed {expected}"
+
+    mg_score, eg_score, game_phase = scores
+    pawns = probe_pawns(white_bbs[0], black_bbs[0], pawn_key)
+
+    score_white_pov = taper(mg_score + pawns.mg_score, eg_score + pawns.eg_score, game_phase)
+    score = score_white_pov if is_whites_move else -score_white_pov
+
+    if key is not None and EVAL_CACHE_SIZE:
+        _eval_cache_keys[slot] = key
+        _eval_cache_values[slot] = score
+
+    return score
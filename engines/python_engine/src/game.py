@@ -1,3 +1,4 @@
+from move_encoding import EP_CAPTURE
 from moves import find_pseudo_legal_moves, in_check
 from utils import get_file, get_rank
 
@@ -91,7 +92,7 @@ def draw_by_insufficient_material(white_bbs, black_bbs):
     return False
 
 
-def has_legal_ep_capture(pawn_bb, legal_moves, en_passant_temp_idx):
+def has_legal_ep_capture(legal_moves, en_passant_temp_idx):
     """
     Check if a side has a legal en passant move
     """
@@ -99,13 +100,8 @@ def has_legal_ep_capture(pawn_bb, legal_moves, en_passant_temp_idx):
     if en_passant_temp_idx == -1:
         return False
 
-    ep_file = get_file(en_passant_temp_idx)
-    for start_square, end_square, _ in legal_moves:
-        if end_square != en_passant_temp_idx:
-            continue
-        if not (1 << start_square & pawn_bb):
-            continue
-        if abs(get_file(start_square) - ep_file) == 1:
+    for move in legal_moves:
+        if move >> 12 == EP_CAPTURE:
             return True
 
     return False
@@ -138,12 +134,7 @@ def set_position_count(
     Update position_counts dictionary and return the updated version alongside the key
     """
 
-    side_pawn_bb = white_bbs[0] if is_whites_move else black_bbs[0]
-    ep_key = (
-        en_passant_temp_idx
-        if has_legal_ep_capture(side_pawn_bb, legal_moves, en_passant_temp_idx)
-        else 0
-    )
+    ep_key = en_passant_temp_idx if has_legal_ep_capture(legal_moves, en_passant_temp_idx) else 0
 
     key = position_key(white_bbs, black_bbs, is_whites_move, castling_rights, ep_key)
     position_counts[key] = position_counts.get(key, 0) + 1
@@ -5,6 +5,7 @@ import time
 import gamestate
 
 from game import draw_by_insufficient_material, game_over_status, update_repetition_count
+from move_encoding import find_matching_move
 from moves import apply_move, find_legal_moves
 from utils import get_rank, output_boardstate
 from engine import evaluate_position
@@ -282,8 +283,8 @@ def main():
         if is_users_move:
             # Repeat until user enters a valid move
             while is_users_move:
-                user_move = get_move(user_bbs[0])
-                is_valid_move = user_move in legal_moves
+                user_move = find_matching_move(legal_moves, *get_move(user_bbs[0]))
+                is_valid_move = user_move is not None
 
                 if is_valid_move:
                     user_bbs, computer_bbs = apply_real_move(user_bbs, computer_bbs, user_move)
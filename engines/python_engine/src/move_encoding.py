@@ -0,0 +1,64 @@
+# Moves are packed into a single 16 bit int, matching the Rust engine's `Move`:
+#
+# bits 0-5: start square
+# bits 6-11: end square
+# bits 12-15: flag
+
+QUIET = 0b0000
+DOUBLE_PUSH = 0b0001
+KING_CASTLE = 0b0010
+QUEEN_CASTLE = 0b0011
+CAPTURE = 0b0100
+EP_CAPTURE = 0b0101
+
+PROMO_N = 0b1000
+PROMO_B = 0b1001
+PROMO_R = 0b1010
+PROMO_Q = 0b1011
+
+PROMO_CAPTURE_N = 0b1100
+PROMO_CAPTURE_B = 0b1101
+PROMO_CAPTURE_R = 0b1110
+PROMO_CAPTURE_Q = 0b1111
+
+# Flag bits as they sit inside a packed move
+CAPTURE_BIT = CAPTURE << 12
+PROMOTION_BIT = 0b1000 << 12
+
+# From/to part of a move, usable as a 12 bit index into per-(from, to) tables
+FROM_TO_MASK = 0xFFF
+
+# Never a legal move (a1 -> a1), used wherever "no move" is needed
+NULL_MOVE = 0
+
+PROMOTION_PIECES = ("n", "b", "r", "q")
+
+
+def move_to_tuple(move):
+    """
+    Convert a packed move to a (start square, end square, promotion piece) tuple
+    """
+
+    promotion_piece = None
+    if move & PROMOTION_BIT:
+        promotion_piece = PROMOTION_PIECES[(move >> 12) & 0b11]
+
+    return move & 0x3F, (move >> 6) & 0x3F, promotion_piece
+
+
+def find_matching_move(legal_moves, start_square, end_square, promotion_piece=None):
+    """
+    Find the packed legal move matching a (start square, end square, promotion piece) move coming
+    from outside the engine, e.g. UCI, the opening book or user input
+
+    Returns None if no legal move matches
+    """
+
+    if promotion_piece is not None:
+        promotion_piece = promotion_piece.lower()
+
+    for move in legal_moves:
+        if move_to_tuple(move) == (start_square, end_square, promotion_piece):
+            return move
+
+    return None
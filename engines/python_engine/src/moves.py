@@ -1,8 +1,97 @@
-from dataclasses import dataclass
-
+from dataclasses import dataclass, field
+
+from attacks import (
+    ALL_SQUARES,
+    BETWEEN,
+    BISHOP_MASKS,
+    BISHOP_TABLES,
+    BLACK_PAWN_ATTACKS,
+    KING_ATTACKS,
+    KNIGHT_ATTACKS,
+    LINE,
+    NOT_FILE_A,
+    NOT_FILE_H,
+    RANK_1,
+    RANK_3,
+    RANK_6,
+    RANK_8,
+    ROOK_MASKS,
+    ROOK_TABLES,
+    WHITE_PAWN_ATTACKS,
+    bishop_attacks,
+    pawn_attacks_bb,
+    pawn_attacks_for,
+    queen_attacks,
+    rook_attacks,
+)
+from evaluation import (
+    EG_PST,
+    MATERIAL_VALUES,
+    MG_PST,
+    PHASE_INC,
+    PST_OFFSETS,
+    material_score,
+    pesto_scores,
+)
 from gamestate import ROOK_START_RIGHTS, WK, WQ, BK, BQ
+from move_encoding import (
+    CAPTURE,
+    CAPTURE_BIT,
+    DOUBLE_PUSH,
+    EP_CAPTURE,
+    KING_CASTLE,
+    PROMOTION_BIT,
+    PROMO_B,
+    PROMO_N,
+    PROMO_Q,
+    PROMO_R,
+    QUEEN_CASTLE,
+)
+from polyglot_random import RANDOM64
 from profiler import profiled
-from utils import piece_to_bitboard_index, get_rank, get_file
+from utils import get_file
+from zobrist import PAWN_KEY_OFFSETS, compute_pawn_key
+
+# Piece values for static exchange evaluation, by bitboard index: the material values, with a king
+# worth more than anything it could capture
+SEE_VALUES = MATERIAL_VALUES[:5] + (20000,)
+
+# Which moves `find_pseudo_legal_moves` and `find_legal_moves` generate
+GEN_ALL = 0
+GEN_NOISY = 1  # captures, en passant and promotions
+GEN_QUIET = 2  # everything else, including castling
+
+
+def get_occupancies(player_bbs, opposition_bbs):
+    """
+    Get the (player_occ, opposition_occ) occupancy bitboards of both sides
+    """
+
+    # fmt: off
+    return (
+        player_bbs[0] | player_bbs[1] | player_bbs[2] | player_bbs[3] | player_bbs[4] | player_bbs[5],
+        opposition_bbs[0] | opposition_bbs[1] | opposition_bbs[2] | opposition_bbs[3] | opposition_bbs[4] | opposition_bbs[5],
+    )
+    # fmt: on
+
+
+def get_piece_board(player_bbs, opposition_bbs):
+    """
+    Build a 64 entry list holding the bitboard index of the piece on each square, or None if empty
+
+    The colour of a piece is found from the occupancy bitboards
+    """
+
+    board = [None] * 64
+
+    for bbs in (player_bbs, opposition_bbs):
+        for piece_idx, bb in enumerate(bbs):
+            while bb:
+                bit = bb & -bb
+                board[bit.bit_length() - 1] = piece_idx
+                bb ^= bit
+
+    return board
 
 
 @profiled()
@@ -16,8 +105,37 @@ class SearchState:
     en_passant_real_idx: int
     halfmove_clock: int
 
+    # Occupancies are kept up to date by make/unmake, so they are derived from the bitboards once
+    player_occ: int = field(init=False)
+    opposition_occ: int = field(init=False)
+    occupied: int = field(init=False)
 
-@dataclass
+    # Piece on each square, also kept up to date by make/unmake
+    board: list[int | None] = field(init=False)
+
+    # Evaluation scores from white's point of view, updated by the pieces make/unmake move
+    mg_score: int = field(init=False)
+    eg_score: int = field(init=False)
+    phase: int = field(init=False)
+    material: int = field(init=False)
+
+    # Zobrist key of only the pawns, for the pawn hash table
+    pawn_key: int = field(init=False)
+
+    def __post_init__(self):
+        self.player_occ, self.opposition_occ = get_occupancies(self.player_bbs, self.opposition_bbs)
+        self.occupied = self.player_occ | self.opposition_occ
+        self.board = get_piece_board(self.player_bbs, self.opposition_bbs)
+
+        white_bbs, black_bbs = self.player_bbs, self.opposition_bbs
+        if not self.is_whites_move:
+            white_bbs, black_bbs = black_bbs, white_bbs
+        self.mg_score, self.eg_score, self.phase = pesto_scores(white_bbs, black_bbs)
+        self.material = material_score(white_bbs, black_bbs)
+        self.pawn_key = compute_pawn_key(white_bbs[0], black_bbs[0])
+
+
+@dataclass(slots=True)
 class Undo:
     moved_piece_idx: int
     start_square: int
@@ -26,47 +144,77 @@ class Undo:
     en_passant_real_idx: int
     castling_rights: int
     halfmove_clock: int
-    promotion_piece: str | None = None
+    promotion_piece_idx: int | None = None
     captured_piece_idx: int | None = None
     captured_piece_square: int | None = None
+    mg_score: int = 0
+    eg_score: int = 0
+    phase: int = 0
+    material: int = 0
+    pawn_key: int = 0
 
 
 # @profiled()
-def make_move_inplace(state: SearchState, move) -> Undo:
+def make_move_inplace(state: SearchState, move, undo: Undo | None = None) -> Undo:
     """
     Apply `move` to `state` inplace, and return an `Undo` object containing the information
     of the before state before the move so it can later be restored
-    """
 
-    def _get_bb_idx(bbs, bit):
-        for idx, bb in enumerate(bbs):
-            if bit & bb:
-                return idx
-        return None
+    If `undo` is passed (e.g. a preallocated slot of the search's undo stack) it is overwritten
+    and returned instead of allocating a new one
+    """
 
-    start_sq, end_sq, promo = move
+    board = state.board
+    start_sq, end_sq, flag = move & 0x3F, (move >> 6) & 0x3F, move >> 12
     start_bit, end_bit = 1 << start_sq, 1 << end_sq
 
-    moved_piece_idx = _get_bb_idx(state.player_bbs, start_bit)
-    captured_piece_idx = _get_bb_idx(state.opposition_bbs, end_bit)
-
-    undo = Undo(
-        moved_piece_idx=moved_piece_idx,
-        start_square=start_sq,
-        end_square=end_sq,
-        en_passant_temp_idx=state.en_passant_temp_idx,
-        en_passant_real_idx=state.en_passant_real_idx,
-        castling_rights=state.castling_rights,
-        halfmove_clock=state.halfmove_clock,
-        promotion_piece=promo,
-        captured_piece_idx=captured_piece_idx,
-    )
+    moved_piece_idx = board[start_sq]
+    captured_piece_idx = None
+    if flag & CAPTURE and flag != EP_CAPTURE:
+        captured_piece_idx = board[end_sq]
+
+    promotion_piece_idx = None
+    if move & PROMOTION_BIT:
+        promotion_piece_idx = (flag & 0b11) + 1
+
+    if undo is None:
+        undo = Undo(
+            moved_piece_idx=moved_piece_idx,
+            start_square=start_sq,
+            end_square=end_sq,
+            en_passant_temp_idx=state.en_passant_temp_idx,
+            en_passant_real_idx=state.en_passant_real_idx,
+            castling_rights=state.castling_rights,
+            halfmove_clock=state.halfmove_clock,
+            promotion_piece_idx=promotion_piece_idx,
+            captured_piece_idx=captured_piece_idx,
+        )
+    else:
+        undo.moved_piece_idx = moved_piece_idx
+        undo.start_square = start_sq
+        undo.end_square = end_sq
+        undo.en_passant_temp_idx = state.en_passant_temp_idx
+        undo.en_passant_real_idx = state.en_passant_real_idx
+        undo.castling_rights = state.castling_rights
+        undo.halfmove_clock = state.halfmove_clock
+        undo.promotion_piece_idx = promotion_piece_idx
+        undo.captured_piece_idx = captured_piece_idx
+        undo.captured_piece_square = None
+
+    undo.mg_score = state.mg_score
+    undo.eg_score = state.eg_score
+    undo.phase = state.phase
+    undo.material = state.material
+    undo.pawn_key = state.pawn_key
 
     state.halfmove_clock += 1
+    state.player_occ ^= start_bit | end_bit
 
     # Remove en passanted pawn first so we can reset en passant indexes
-    if moved_piece_idx == 0 and end_sq == state.en_passant_temp_idx:
+    if flag == EP_CAPTURE:
         state.opposition_bbs[0] ^= 1 << state.en_passant_real_idx
+        state.opposition_occ ^= 1 << state.en_passant_real_idx
+        board[state.en_passant_real_idx] = None
 
         # Store location of en passanted pawn in undo
         undo.captured_piece_idx = 0
@@ -77,15 +225,16 @@ def make_move_inplace(state: SearchState, move) -> Undo:
 
     # Move piece
     state.player_bbs[moved_piece_idx] ^= start_bit  # Remove piece
-    if promo is None:
+    board[start_sq] = None
+    if promotion_piece_idx is None:
         state.player_bbs[moved_piece_idx] ^= end_bit
+        board[end_sq] = moved_piece_idx
 
         if moved_piece_idx == 0:
             state.halfmove_clock = 0
 
             # Update en passant data if needed
-            move_delta = end_sq - start_sq
-            if abs(move_delta) == 16:
+            if flag == DOUBLE_PUSH:
                 state.en_passant_real_idx = end_sq
                 state.en_passant_temp_idx = (start_sq + end_sq) // 2
         elif moved_piece_idx == 3:
@@ -98,22 +247,28 @@ def make_move_inplace(state: SearchState, move) -> Undo:
             state.castling_rights &= castling_mask
 
             # Castling also moves rook
-            move_delta = end_sq - start_sq
-            if move_delta == 2:  # kingside
+            if flag == KING_CASTLE:
                 state.player_bbs[3] ^= 1 << (start_sq + 3)
                 state.player_bbs[3] ^= 1 << (start_sq + 1)
-            elif move_delta == -2:  # queenside
+                state.player_occ ^= (1 << (start_sq + 3)) | (1 << (start_sq + 1))
+                board[start_sq + 3] = None
+                board[start_sq + 1] = 3
+            elif flag == QUEEN_CASTLE:
                 state.player_bbs[3] ^= 1 << (start_sq - 4)
                 state.player_bbs[3] ^= 1 << (start_sq - 1)
+                state.player_occ ^= (1 << (start_sq - 4)) | (1 << (start_sq - 1))
+                board[start_sq - 4] = None
+                board[start_sq - 1] = 3
     else:
         state.halfmove_clock = 0
-        promo_idx = piece_to_bitboard_index(promo)
-        state.player_bbs[promo_idx] ^= end_bit  # Place promoted piece
+        state.player_bbs[promotion_piece_idx] ^= end_bit  # Place promoted piece
+        board[end_sq] = promotion_piece_idx
 
     # Remove captured piece
     if captured_piece_idx is not None:
         state.halfmove_clock = 0
         state.opposition_bbs[captured_piece_idx] ^= end_bit
+        state.opposition_occ ^= end_bit
 
         undo.captured_piece_square = end_sq
 
@@ -123,8 +278,56 @@ def make_move_inplace(state: SearchState, move) -> Undo:
             if key in ROOK_START_RIGHTS:
                 state.castling_rights &= ~ROOK_START_RIGHTS[key]
 
+    # Update the evaluation scores by the piece-square values of the pieces which moved
+    is_white = state.is_whites_move
+    offset = PST_OFFSETS[is_white]
+    placed_piece_idx = moved_piece_idx if promotion_piece_idx is None else promotion_piece_idx
+    from_idx = offset + 64 * moved_piece_idx + start_sq
+    to_idx = offset + 64 * placed_piece_idx + end_sq
+    mg_score = state.mg_score + MG_PST[to_idx] - MG_PST[from_idx]
+    eg_score = state.eg_score + EG_PST[to_idx] - EG_PST[from_idx]
+
+    # Material is from white's point of view, like the scores
+    material_sign = 1 if is_white else -1
+
+    if promotion_piece_idx is not None:
+        state.phase += PHASE_INC[promotion_piece_idx]
+        state.material += material_sign * (MATERIAL_VALUES[promotion_piece_idx] - MATERIAL_VALUES[0])
+
+    if undo.captured_piece_idx is not None:
+        captured_idx = (
+            PST_OFFSETS[not is_white] + 64 * undo.captured_piece_idx + undo.captured_piece_square
+        )
+        mg_score -= MG_PST[captured_idx]
+        eg_score -= EG_PST[captured_idx]
+        state.phase -= PHASE_INC[undo.captured_piece_idx]
+        state.material += material_sign * MATERIAL_VALUES[undo.captured_piece_idx]
+
+        if undo.captured_piece_idx == 0:
+            state.pawn_key ^= RANDOM64[PAWN_KEY_OFFSETS[not is_white] + undo.captured_piece_square]
+
+    if moved_piece_idx == 0:
+        pawn_offset = PAWN_KEY_OFFSETS[is_white]
+        state.pawn_key ^= RANDOM64[pawn_offset + start_sq]
+        if promotion_piece_idx is None:
+            state.pawn_key ^= RANDOM64[pawn_offset + end_sq]
+
+    if flag == KING_CASTLE or flag == QUEEN_CASTLE:
+        if flag == KING_CASTLE:
+            rook_from, rook_to = start_sq + 3, start_sq + 1
+        else:
+            rook_from, rook_to = start_sq - 4, start_sq - 1
+        rook_base = offset + 64 * 3
+        mg_score += MG_PST[rook_base + rook_to] - MG_PST[rook_base + rook_from]
+        eg_score += EG_PST[rook_base + rook_to] - EG_PST[rook_base + rook_from]
+
+    state.mg_score = mg_score
+    state.eg_score = eg_score
+
     state.is_whites_move = not state.is_whites_move
     state.player_bbs, state.opposition_bbs = state.opposition_bbs, state.player_bbs
+    state.player_occ, state.opposition_occ = state.opposition_occ, state.player_occ
+    state.occupied = state.player_occ | state.opposition_occ
 
     return undo
 
@@ -136,16 +339,20 @@ def unmake_move_inplace(state: SearchState, undo: Undo):
     """
 
     state.player_bbs, state.opposition_bbs = state.opposition_bbs, state.player_bbs
+    state.player_occ, state.opposition_occ = state.opposition_occ, state.player_occ
     state.is_whites_move = not state.is_whites_move
 
     # Place moved piece back to where it was
+    board = state.board
     state.player_bbs[undo.moved_piece_idx] ^= 1 << undo.start_square
+    state.player_occ ^= (1 << undo.start_square) | (1 << undo.end_square)
+    board[undo.start_square] = undo.moved_piece_idx
+    board[undo.end_square] = None
 
     # Remove piece from where it was moved to, considering promotion and check
-    if undo.promotion_piece is not None:
+    if undo.promotion_piece_idx is not None:
         # Remove promoted piece
-        promotion_idx = piece_to_bitboard_index(undo.promotion_piece)
-        state.player_bbs[promotion_idx] ^= 1 << undo.end_square
+        state.player_bbs[undo.promotion_piece_idx] ^= 1 << undo.end_square
     elif undo.moved_piece_idx == 5:
         # Remove king
         state.player_bbs[5] ^= 1 << undo.end_square
@@ -155,9 +362,15 @@ def unmake_move_inplace(state: SearchState, undo: Undo):
         if move_delta == 2:  # kingside
             state.player_bbs[3] ^= 1 << (undo.start_square + 1)
             state.player_bbs[3] ^= 1 << (undo.start_square + 3)
+            state.player_occ ^= (1 << (undo.start_square + 1)) | (1 << (undo.start_square + 3))
+            board[undo.start_square + 1] = None
+            board[undo.start_square + 3] = 3
         elif move_delta == -2:  # queenside
             state.player_bbs[3] ^= 1 << (undo.start_square - 1)
             state.player_bbs[3] ^= 1 << (undo.start_square - 4)
+            state.player_occ ^= (1 << (undo.start_square - 1)) | (1 << (undo.start_square - 4))
+            board[undo.start_square - 1] = None
+            board[undo.start_square - 4] = 3
     else:
         # Remove remaining pieces
         state.player_bbs[undo.moved_piece_idx] ^= 1 << undo.end_square
@@ -165,39 +378,40 @@ def unmake_move_inplace(state: SearchState, undo: Undo):
     # Replace captured piece, if there was one
     if undo.captured_piece_idx is not None:
         state.opposition_bbs[undo.captured_piece_idx] ^= 1 << undo.captured_piece_square
+        state.opposition_occ ^= 1 << undo.captured_piece_square
+        board[undo.captured_piece_square] = undo.captured_piece_idx
+
+    state.occupied = state.player_occ | state.opposition_occ
 
     state.castling_rights = undo.castling_rights
     state.en_passant_temp_idx = undo.en_passant_temp_idx
     state.en_passant_real_idx = undo.en_passant_real_idx
     state.halfmove_clock = undo.halfmove_clock
+    state.mg_score = undo.mg_score
+    state.eg_score = undo.eg_score
+    state.phase = undo.phase
+    state.material = undo.material
+    state.pawn_key = undo.pawn_key
 
 
-def walk_ray(square, player_occ, opposition_occ, rank, file, dr, df):
+def append_target_moves(moves, square, targets, opposition_occ):
     """
-    Walk one direction until blocked or reached edge of the board and return all valid moves
+    Append a move from `square` to every square set in the `targets` bitboard, flagging the ones
+    landing on an opposition piece as captures
     """
 
-    moves = []
+    captures = targets & opposition_occ
+    quiets = targets ^ captures
 
-    move_rank, move_file = rank + dr, file + df
-    while 0 <= move_rank <= 7 and 0 <= move_file <= 7:
-        move_square = 8 * move_rank + move_file
-        move_bit = 1 << move_square
+    while captures:
+        lsb = captures & -captures
+        moves.append(square | ((lsb.bit_length() - 1) << 6) | CAPTURE_BIT)
+        captures ^= lsb
 
-        # Blocked by own piece
-        if move_bit & player_occ:
-            break
-
-        moves.append((square, move_square, None))
-
-        # Capturing so stop ray
-        if move_bit & opposition_occ:
-            break
-
-        move_rank += dr
-        move_file += df
-
-    return moves
+    while quiets:
+        lsb = quiets & -quiets
+        moves.append(square | ((lsb.bit_length() - 1) << 6))
+        quiets ^= lsb
 
 
 # @profiled()
@@ -217,144 +431,133 @@ def get_castling_rights(castling_rights):
 
 
 # @profiled()
-def is_on_promotion_rank(rank, is_whites_move):
-    """
-    Checks if a specified rank is the promotion rank for the specified colour
-    """
-
-    return rank == 7 if is_whites_move else rank == 0
-
-
-# @profiled()
-def get_promotion_moves(start_square, end_square):
+def get_promotion_moves(start_square, end_square, capture_flag=0):
     """
     Returns a list of all four possible promotion moves
     """
 
+    move = start_square | (end_square << 6)
     return [
-        (start_square, end_square, "q"),
-        (start_square, end_square, "n"),
-        (start_square, end_square, "b"),
-        (start_square, end_square, "r"),
+        move | ((PROMO_Q | capture_flag) << 12),
+        move | ((PROMO_N | capture_flag) << 12),
+        move | ((PROMO_B | capture_flag) << 12),
+        move | ((PROMO_R | capture_flag) << 12),
     ]
 
 
-# @profiled()
-def find_pawn_moves(pawn_bb, player_occ, opposition_occ, is_whites_move, en_passant_temp_idx):
+def append_pawn_moves(moves, targets, delta, flag):
     """
-    Find possible pawn moves
+    Append a pawn move to every square set in `targets`, where each pawn moved `delta` squares
     """
 
-    all_occ = player_occ | opposition_occ
-
-    # @profiled()
-    def can_forward_move(square, rank):
-        """
-        Check if a pawn can do a regular or double forward move, and returns whichever ones it can do
-        """
-
-        moves = []
+    while targets:
+        lsb = targets & -targets
+        end_square = lsb.bit_length() - 1
+        moves.append((end_square - delta) | (end_square << 6) | (flag << 12))
+        targets ^= lsb
 
-        # Check if a pawn can move a single square forward
-        move_square = square + 8 if is_whites_move else square - 8
-        if move_square < 0 or move_square > 63:
-            return moves
 
-        move_bit = 1 << move_square
-        cannot_single_move = bool(move_bit & all_occ)
-
-        if cannot_single_move:
-            return moves
-
-        # Four possible promotions
-        move_rank = rank + 1 if is_whites_move else rank - 1
-        if is_on_promotion_rank(move_rank, is_whites_move):
-            promotion_moves = get_promotion_moves(square, move_square)
-            moves.extend(promotion_moves)
-            return moves
+def append_pawn_promotions(moves, targets, delta, capture_flag=0):
+    """
+    Append all four promotion moves to every square set in `targets`, where each pawn moved
+    `delta` squares
+    """
 
-        moves.append((square, move_square, None))
+    while targets:
+        lsb = targets & -targets
+        end_square = lsb.bit_length() - 1
+        moves.extend(get_promotion_moves(end_square - delta, end_square, capture_flag))
+        targets ^= lsb
 
-        # Check if a pawn can double move forward
-        move_square = square + 16 if is_whites_move else square - 16
-        # Only allow double moves on home row
-        on_home_row = (rank == 1 and is_whites_move) or (rank == 6 and not is_whites_move)
 
-        if not on_home_row:
-            return moves
+# @profiled()
+def find_pawn_moves(
+    pawn_bb,
+    player_occ,
+    opposition_occ,
+    is_whites_move,
+    en_passant_temp_idx,
+    gen_type=GEN_ALL,
+    target_mask=ALL_SQUARES,
+):
+    """
+    Find possible pawn moves, restricted to noisy or quiet moves by `gen_type`, and to landing on
+    `target_mask` for every move except en passant
 
-        move_bit = 1 << move_square
-        cannot_double_move = bool(move_bit & all_occ)
+    Moves are found set-wise by shifting the whole pawn bitboard, then expanded into moves by
+    iterating over the target squares
 
-        if cannot_double_move:
-            return moves
+    Returns a list of capturing moves (including en passant) and a list of forward moves
+    """
 
-        moves.append((square, move_square, None))
-        return moves
+    empty = ALL_SQUARES ^ (player_occ | opposition_occ)
 
-    pawn_capture_moves = [7, 9] if is_whites_move else [-7, -9]
+    # Deltas for a forward, left capture (towards the a-file) and right capture move
+    if is_whites_move:
+        push, left, right = 8, 7, 9
+        single_pushes = (pawn_bb << 8) & empty
+        double_pushes = ((single_pushes & RANK_3) << 8) & empty
+        left_captures = (pawn_bb << 7) & NOT_FILE_H & opposition_occ
+        right_captures = (pawn_bb << 9) & NOT_FILE_A & opposition_occ
+        promotion_rank = RANK_8
+    else:
+        push, left, right = -8, -9, -7
+        single_pushes = (pawn_bb >> 8) & empty
+        double_pushes = ((single_pushes & RANK_6) >> 8) & empty
+        left_captures = (pawn_bb >> 9) & NOT_FILE_H & opposition_occ
+        right_captures = (pawn_bb >> 7) & NOT_FILE_A & opposition_occ
+        promotion_rank = RANK_1
+
+    single_pushes &= target_mask
+    double_pushes &= target_mask
+    left_captures &= target_mask
+    right_captures &= target_mask
 
     moves = []
     capture_moves = []
 
-    while pawn_bb:
-        lsb = pawn_bb & -pawn_bb
-        square = lsb.bit_length() - 1
-        rank = get_rank(square)
-
-        moves.extend(can_forward_move(square, rank))
-
-        for move in pawn_capture_moves:
-            move_square = square + move
-            if move_square < 0 or move_square > 63:
-                # If the first capturing move is out of bounds, the second one must also be, so break
-                break
-
-            move_rank = get_rank(move_square)
-
-            # Check if capture move went around the edge of the board, i.e., it moves zero or two ranks
-            if abs(rank - move_rank) != 1:
-                continue
-
-            # Check if square has enemy piece which can be captured
-            move_bit = 1 << move_square
-            if move_bit & opposition_occ:
-                if is_on_promotion_rank(move_rank, is_whites_move):
-                    promotion_moves = get_promotion_moves(square, move_square)
-                    capture_moves.extend(promotion_moves)
-                else:
-                    capture_moves.append((square, move_square, None))
-
-                continue  # skip en passant check
-
-            # En passant
-            if move_square == en_passant_temp_idx:
-                capture_moves.append((square, move_square, None))
-
-        pawn_bb ^= lsb
+    if gen_type != GEN_QUIET:
+        append_pawn_promotions(capture_moves, left_captures & promotion_rank, left, CAPTURE)
+        append_pawn_promotions(capture_moves, right_captures & promotion_rank, right, CAPTURE)
+        append_pawn_moves(capture_moves, left_captures & ~promotion_rank, left, CAPTURE)
+        append_pawn_moves(capture_moves, right_captures & ~promotion_rank, right, CAPTURE)
+
+        # En passant target is always empty, so it can never be on the promotion rank
+        if en_passant_temp_idx >= 0:
+            # Pawns able to capture en passant sit where an enemy pawn on the target would attack
+            ep_pawns = pawn_attacks_for(not is_whites_move)[en_passant_temp_idx] & pawn_bb
+            while ep_pawns:
+                lsb = ep_pawns & -ep_pawns
+                capture_moves.append(
+                    (lsb.bit_length() - 1) | (en_passant_temp_idx << 6) | (EP_CAPTURE << 12)
+                )
+                ep_pawns ^= lsb
+
+        append_pawn_promotions(moves, single_pushes & promotion_rank, push)
+
+    if gen_type != GEN_NOISY:
+        append_pawn_moves(moves, single_pushes & ~promotion_rank, push, 0)
+        append_pawn_moves(moves, double_pushes, 2 * push, DOUBLE_PUSH)
 
     return capture_moves, moves
 
 
 # @profiled()
-def find_rook_moves(rook_bb, player_occ, opposition_occ):
+def find_rook_moves(rook_bb, player_occ, opposition_occ, target_mask=ALL_SQUARES):
     """
     Find possible rook moves
     """
 
     moves = []
+    occupied = player_occ | opposition_occ
+    not_player_occ = ~player_occ & target_mask
 
     while rook_bb:
         lsb = rook_bb & -rook_bb
         square = lsb.bit_length() - 1
-        rank = get_rank(square)
-        file = get_file(square)
 
-        # Check all 4 rook directions: right, left, up, down
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 1, 0))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, -1, 0))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 0, 1))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 0, -1))
+        targets = ROOK_TABLES[square][occupied & ROOK_MASKS[square]] & not_player_occ
+        append_target_moves(moves, square, targets, opposition_occ)
 
         rook_bb ^= lsb
 
@@ -362,38 +565,20 @@ def find_rook_moves(rook_bb, player_occ, opposition_occ):
 
 
 # @profiled()
-def find_knight_moves(knight_bb, player_occ):
+def find_knight_moves(knight_bb, player_occ, opposition_occ, target_mask=ALL_SQUARES):
     """
     Find possible knight moves
     """
 
-    knight_moves = [(2, -1), (2, 1), (1, 2), (1, -2), (-2, 1), (-2, -1), (-1, -2), (-1, 2)]
-
     moves = []
+    not_player_occ = ~player_occ & target_mask
 
     while knight_bb:
         lsb = knight_bb & -knight_bb
         square = lsb.bit_length() - 1
-        rank = get_rank(square)
-        file = get_file(square)
-
-        for dr, df in knight_moves:
-            move_rank = rank + dr
-            if move_rank > 7 or move_rank < 0:
-                continue
-
-            move_file = file + df
-            if move_file > 7 or move_file < 0:
-                continue
-
-            move_square = 8 * move_rank + move_file
-            move_bit = 1 << move_square
-
-            # Blocked by own piece
-            if move_bit & player_occ:
-                continue
 
-            moves.append((square, move_square, None))
+        # Every attacked square not blocked by an own piece
+        append_target_moves(moves, square, KNIGHT_ATTACKS[square] & not_player_occ, opposition_occ)
 
         knight_bb ^= lsb
 
@@ -401,24 +586,21 @@ def find_knight_moves(knight_bb, player_occ):
 
 
 # @profiled()
-def find_bishop_moves(bishop_bb, player_occ, opposition_occ):
+def find_bishop_moves(bishop_bb, player_occ, opposition_occ, target_mask=ALL_SQUARES):
     """
     Find possible bishop moves
     """
 
     moves = []
+    occupied = player_occ | opposition_occ
+    not_player_occ = ~player_occ & target_mask
 
     while bishop_bb:
         lsb = bishop_bb & -bishop_bb
         square = lsb.bit_length() - 1
-        rank = get_rank(square)
-        file = get_file(square)
 
-        # Check all 4 bishop directions
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 1, 1))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 1, -1))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, -1, 1))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, -1, -1))
+        targets = BISHOP_TABLES[square][occupied & BISHOP_MASKS[square]] & not_player_occ
+        append_target_moves(moves, square, targets, opposition_occ)
 
         bishop_bb ^= lsb
 
@@ -426,28 +608,25 @@ def find_bishop_moves(bishop_bb, player_occ, opposition_occ):
 
 
 # @profiled()
-def find_queen_moves(queen_bb, player_occ, opposition_occ):
+def find_queen_moves(queen_bb, player_occ, opposition_occ, target_mask=ALL_SQUARES):
     """
     Find possible queen moves
     """
 
     moves = []
+    occupied = player_occ | opposition_occ
+    not_player_occ = ~player_occ & target_mask
 
     while queen_bb:
         lsb = queen_bb & -queen_bb
         square = lsb.bit_length() - 1
-        rank = get_rank(square)
-        file = get_file(square)
-
-        # Check all 8 queen directions
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 1, 0))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, -1, 0))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 0, 1))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 0, -1))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 1, 1))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, 1, -1))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, -1, 1))
-        moves.extend(walk_ray(square, player_occ, opposition_occ, rank, file, -1, -1))
+
+        # Queen attacks are the union of rook and bishop attacks from the same square
+        targets = (
+            ROOK_TABLES[square][occupied & ROOK_MASKS[square]]
+            | BISHOP_TABLES[square][occupied & BISHOP_MASKS[square]]
+        ) & not_player_occ
+        append_target_moves(moves, square, targets, opposition_occ)
 
         queen_bb ^= lsb
 
@@ -455,7 +634,15 @@ def find_queen_moves(queen_bb, player_occ, opposition_occ):
 
 
 # @profiled()
-def find_king_moves(king_bb, rook_bb, player_occ, opposition_occ, is_whites_move, castling_rights):
+def find_king_moves(
+    king_bb,
+    rook_bb,
+    player_occ,
+    opposition_occ,
+    is_whites_move,
+    castling_rights,
+    target_mask=ALL_SQUARES,
+):
     """
     Find possible king moves
     """
@@ -465,41 +652,18 @@ def find_king_moves(king_bb, rook_bb, player_occ, opposition_occ, is_whites_move
     moves = []
     castling_moves = []
 
-    king_moves = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
-
     if king_bb == 0:
         return moves, castling_moves
 
     square = king_bb.bit_length() - 1
-    rank = get_rank(square)
-    file = get_file(square)
+    king_attacks = KING_ATTACKS[square]
 
-    kingside_free, queenside_free = False, False
-    for dr, df in king_moves:
-        move_rank = rank + dr
-        move_file = file + df
+    append_target_moves(moves, square, king_attacks & ~player_occ & target_mask, opposition_occ)
 
-        if 0 <= move_rank <= 7 and 0 <= move_file <= 7:
-            move_square = 8 * move_rank + move_file
-            move_bit = 1 << move_square
-
-            # Blocked by friendly piece
-            if move_bit & player_occ:
-                continue
-
-            moves.append((square, move_square, None))
-
-            # If a left/right move is a capturing move, i.e. you cannot castle in that direction
-            if dr != 0 or (move_bit & opposition_occ):
-                continue
-
-            # Square to the left (kingside) or right (queenside) of king is free
-            if df == 1:
-                kingside_free = True
-            else:
-                queenside_free = True
-        else:
-            continue
+    # Square to the left (kingside) or right (queenside) of king is on the board and empty
+    file = get_file(square)
+    kingside_free = file != 7 and not ((1 << (square + 1)) & all_occ)
+    queenside_free = file != 0 and not ((1 << (square - 1)) & all_occ)
 
     BQ_rights, BK_rights, WQ_rights, WK_rights = get_castling_rights(castling_rights)
 
@@ -520,7 +684,7 @@ def find_king_moves(king_bb, rook_bb, player_occ, opposition_occ, is_whites_move
         move_square = square + k_step
         move_bit = 1 << move_square
         if not (move_bit & all_occ) and rook_exists:
-            castling_moves.append((square, move_square, None))
+            castling_moves.append(square | (move_square << 6) | (KING_CASTLE << 12))
 
     # check queenside castling
     if queenside_free and q_rights:
@@ -536,7 +700,7 @@ def find_king_moves(king_bb, rook_bb, player_occ, opposition_occ, is_whites_move
             and not (move_q_extra_bit & all_occ)
             and rook_exists
         ):
-            castling_moves.append((square, move_square, None))
+            castling_moves.append(square | (move_square << 6) | (QUEEN_CASTLE << 12))
 
     return moves, castling_moves
 
@@ -547,7 +711,7 @@ def in_check(king_square, opposition_moves):
     Check if the opponents pieces can attack the king
     """
 
-    return any(sq == king_square for _, sq, _ in opposition_moves)
+    return any((move >> 6) & 0x3F == king_square for move in opposition_moves)
 
 
 # @profiled()
@@ -566,37 +730,27 @@ def apply_move_lightweight(
     - Updating halfmove clock
     """
 
-    start_idx, end_idx, _ = move
+    start_idx, end_idx = move & 0x3F, (move >> 6) & 0x3F
     start_square, end_square = 1 << start_idx, 1 << end_idx
 
     new_player = player_bbs[:]
     new_opposition = opposition_bbs[:]
 
-    moved_piece_idx = None
-
     for idx, bb in enumerate(new_player):
         # Find bb of the moved piece
         if bb & start_square:
             # Move the moved piece
-            moved_piece_idx = idx
             new_player[idx] ^= start_square
             new_player[idx] ^= end_square
             break
 
     # Check for en passant
-    if moved_piece_idx == 0 and end_idx == en_passant_temp_idx:
+    if move >> 12 == EP_CAPTURE:
         new_opposition[0] ^= 1 << en_passant_real_idx
         return new_player, new_opposition
 
     # Move is not a capture move
-    if not end_square & (
-        new_opposition[0]
-        | new_opposition[1]
-        | new_opposition[2]
-        | new_opposition[3]
-        | new_opposition[4]
-        | new_opposition[5]
-    ):
+    if not move & CAPTURE_BIT:
         return new_player, new_opposition
 
     for idx, bb in enumerate(new_opposition):
@@ -609,118 +763,65 @@ def apply_move_lightweight(
 
 
 # @profiled()
-def analyse_king_lines(player_bbs, opposition_bbs, is_whites_move):
+def analyse_king_lines(player_bbs, opposition_bbs, is_whites_move, occupancies=None):
     """
+    `occupancies` is an optional (player_occ, opposition_occ) pair, e.g. from a `SearchState`
+
     Returns:
     - `king_square`: int
     - `checkers_bb`: int
-    - `pinned_masks`: dict[int, int] - pinned start square -> allowed end mask
+    - `pinned_bb`: int - own pieces pinned to the king, which may only move along the king's line
     - `evasion_mask`: int - valid non-king destinations in a single check (i.e. captures and blocks)
     """
 
-    def piece_idx_at(bit):
-        for idx, bb in enumerate(opposition_bbs):
-            if bb & bit:
-                return idx
-        return None
-
-    # fmt: off
-    player_occ = player_bbs[0] | player_bbs[1] | player_bbs[2] | player_bbs[3] | player_bbs[4] | player_bbs[5]
-    opposition_occ = opposition_bbs[0] | opposition_bbs[1] | opposition_bbs[2] | opposition_bbs[3] | opposition_bbs[4] | opposition_bbs[5]
-    # fmt: on
+    if occupancies is None:
+        occupancies = get_occupancies(player_bbs, opposition_bbs)
+    player_occ, opposition_occ = occupancies
 
     king_bb = player_bbs[5]
     king_square = king_bb.bit_length() - 1
-    k_rank, k_file = king_square >> 3, king_square & 7
 
     checkers_bb = 0
-    pinned_masks = {}
+    pinned_bb = 0
     evasion_mask = 0
 
-    # 8 king rays
-    # fmt: off
-    directions = (
-        (1, 0, True), (-1, 0, True), (0, 1, True), (0, -1, True), # orthogonal
-        (1, 1, False), (1, -1, False), (-1, 1, False), (-1, -1, False), # diagonal
-    )
-    # fmt: on
-
-    for dr, df, orth in directions:
-        rank, file = k_rank + dr, k_file + df
-        first_own_square = -1
-        ray_mask = 0  # squares from king outward (excluding the king)
+    # Enemy sliders which see the king when only enemy pieces block, i.e. through our own pieces
+    snipers = rook_attacks(king_square, opposition_occ) & (
+        opposition_bbs[3] | opposition_bbs[4]
+    ) | bishop_attacks(king_square, opposition_occ) & (opposition_bbs[2] | opposition_bbs[4])
+    between = BETWEEN[king_square]
 
-        while 0 <= rank <= 7 and 0 <= file <= 7:
-            square = 8 * rank + file
-            bit = 1 << square
+    while snipers:
+        bit = snipers & -snipers
 
-            # Ray collision with own piece
-            if player_occ & bit:
-                # Collided with more than 1 piece so no pin
-                if first_own_square != -1:
-                    break
+        # Squares strictly between the king and the sniper
+        ray_mask = between[bit.bit_length() - 1]
+        blockers = ray_mask & player_occ
 
-                first_own_square = square
-                rank += dr
-                file += df
-                continue
+        # Piece is not blocked, i.e. it is checking the king
+        if not blockers:
+            checkers_bb |= bit
 
-            # Ray collision with opposition piece
-            if opposition_occ & bit:
-                idx = piece_idx_at(bit)
-                # Check if collided piece can move orthogonally (queen and rook) or diagonally (queen and bishop)
-                slider_ok = (idx in (3, 4)) if orth else (idx in (2, 4))
-
-                if slider_ok:
-                    # Piece is not blocked, i.e. it is checking the king
-                    if first_own_square == -1:
-                        checkers_bb |= bit
-
-                        if checkers_bb.bit_count() == 1:
-                            # Squares which, if occupied, will block the single check
-                            evasion_mask = ray_mask | bit
-                    else:
-                        pinned_masks[first_own_square] = ray_mask | bit
-                break
+            if checkers_bb.bit_count() == 1:
+                # Squares which, if occupied, will block the single check
+                evasion_mask = ray_mask | bit
+        # Exactly one own piece in the way, so it can only move along the pin
+        elif blockers.bit_count() == 1:
+            pinned_bb |= blockers
 
-            ray_mask |= bit
-            rank += dr
-            file += df
+        snipers ^= bit
 
-    # Knight checks
-    knight_bb = opposition_bbs[1]
-    for dr, df in [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)]:
-        rank, file = k_rank + dr, k_file + df
-
-        if 0 <= rank <= 7 and 0 <= file <= 7:
-            square = 8 * rank + file
-            bit = 1 << square
-
-            if knight_bb & bit:
-                checkers_bb |= bit
-                if checkers_bb.bit_count() == 1:
-                    evasion_mask = bit
-
-    # Pawn checks
-    pawn_bb = opposition_bbs[0]
-    attacker_is_white = not is_whites_move
-    pawn_sources = (-9, -7) if attacker_is_white else (7, 9)
-
-    for delta in pawn_sources:
-        square = king_square + delta
-
-        if 0 <= square <= 63:
-            # File guard, pawn attack does not go around the board
-            if abs((square & 7) - k_file) != 1:
-                continue
-
-            bit = 1 << square
-            if pawn_bb & bit:
-                checkers_bb |= bit
-                if checkers_bb.bit_count() == 1:
-                    evasion_mask = bit
+    # Knight and pawn checks, a king can only be checked by one of these at a time
+    # Enemy pawns attacking the king stand on the squares our own pawn would attack from the king
+    leaper_checkers = (KNIGHT_ATTACKS[king_square] & opposition_bbs[1]) | (
+        pawn_attacks_for(is_whites_move)[king_square] & opposition_bbs[0]
+    )
+    if leaper_checkers:
+        checkers_bb |= leaper_checkers
+        if checkers_bb.bit_count() == 1:
+            evasion_mask = leaper_checkers
 
-    return king_square, checkers_bb, pinned_masks, evasion_mask
+    return king_square, checkers_bb, pinned_bb, evasion_mask
 
 
 # @profiled()
@@ -731,50 +832,54 @@ def filter_legal_moves(
     is_whites_move,
     en_passant_temp_idx,
     en_passant_real_idx,
+    king_lines=None,
+    occupancies=None,
+    attack_map=None,
 ):
     """
     Convert a list of all pseudo-legal moves into legal moves, i.e. remove all moves that result in a check
+
+    `king_lines` can be passed in if `analyse_king_lines` has already been run on the position, and
+    `attack_map` if the opposition's `attacked_squares` (without our king blocking) is already known
     """
 
     legal_moves = []
 
-    origin_king_square, checkers_bb, pinned_masks, evasion_mask = analyse_king_lines(
-        player_bbs, opposition_bbs, is_whites_move
-    )
-    num_checkers = checkers_bb.bit_count()
-    can_fast_append_non_king = num_checkers == 0 and not pinned_masks
-    pawn_bb = player_bbs[0]
+    if occupancies is None:
+        occupancies = get_occupancies(player_bbs, opposition_bbs)
+    occupied = occupancies[0] | occupancies[1]
 
-    kingside_clear = False
-    queenside_clear = False
-    all_squares_mask = (1 << 64) - 1
+    if king_lines is None:
+        king_lines = analyse_king_lines(player_bbs, opposition_bbs, is_whites_move, occupancies)
+    origin_king_square, checkers_bb, pinned_bb, evasion_mask = king_lines
+    num_checkers = checkers_bb.bit_count()
+    can_fast_append_non_king = num_checkers == 0 and not pinned_bb
+    king_line = LINE[origin_king_square]
 
     # @profiled()
-    def filter_moves(moves, are_king_moves=False):
+    def filter_moves(moves):
         """
-        Find all moves from a set of moves which result in the king not being in check
+        Find all non-king moves from a set of moves which result in the king not being in check
         """
 
-        nonlocal kingside_clear, queenside_clear
-
         for move in moves:
-            start_sq, end_sq, _ = move
+            start_sq, end_sq = move & 0x3F, (move >> 6) & 0x3F
             end_bit = 1 << end_sq
 
-            is_king_move = are_king_moves
-            is_ep_move = False
-            if not are_king_moves:
-                start_bit = 1 << start_sq
-                is_ep_move = (pawn_bb & start_bit) and end_sq == en_passant_temp_idx
+            is_ep_move = move >> 12 == EP_CAPTURE
 
-            # Not in check and no pinned pieces, so non-king move can be added without checking
+            # Not in check and no pinned pieces, so move can be added without checking
             # Must also exclude en passant moves, as those may leave the king in check despite no pieces being pinned
-            if can_fast_append_non_king and not is_king_move and not is_ep_move:
+            if can_fast_append_non_king and not is_ep_move:
                 legal_moves.append(move)
                 continue
 
-            # Non-king move while in check, so must capture or block
-            if num_checkers == 1 and not is_king_move and not (end_bit & evasion_mask):
+            # Double check, so king must move
+            if num_checkers >= 2:
+                continue
+
+            # Move while in check, so must capture or block
+            if num_checkers == 1 and not (end_bit & evasion_mask):
                 # Allow en passant if checker is ep-capturable pawn
                 if not (is_ep_move and checkers_bb == (1 << en_passant_real_idx)):
                     continue
@@ -782,88 +887,123 @@ def filter_legal_moves(
             # Pinned pieces can only move up/down the pin
             # Skip for en passant as it may reveal a check despite no pieces being pinned
             if not is_ep_move:
-                pin_mask = pinned_masks.get(start_sq, all_squares_mask)
-                if not (end_bit & pin_mask):
-                    continue
-
-            # Double check, so king must move
-            if num_checkers >= 2 and not is_king_move:
+                if not (1 << start_sq) & pinned_bb or end_bit & king_line[start_sq]:
+                    legal_moves.append(move)
                 continue
 
-            # Non-king and non-ep moves are always legal now
-            if not (is_king_move or is_ep_move):
-                legal_moves.append(move)
-                continue
-
-            # Now all that is left to check is king moves and en passant moves
+            # Now all that is left to check is en passant moves
             new_player_bbs, new_opposition_bbs = apply_move_lightweight(
                 player_bbs, opposition_bbs, move, en_passant_temp_idx, en_passant_real_idx
             )
 
-            # See if an opponents piece can attack the king
-            king_bb = new_player_bbs[5]
-            king_square_after = king_bb.bit_length() - 1
-
             # King is not in check so move is legal
             if not is_square_attacked(
-                king_square_after, new_opposition_bbs, new_player_bbs, not is_whites_move
+                origin_king_square, new_opposition_bbs, new_player_bbs, not is_whites_move
             ):
                 legal_moves.append(move)
-                # Set variables for castling
-                if are_king_moves:
-                    move_delta = end_sq - origin_king_square
-                    if move_delta == 1:
-                        kingside_clear = True
-                    elif move_delta == -1:
-                        queenside_clear = True
 
     piece_moves, king_moves, castling_moves, pawn_moves = pseudo_legal_moves
 
-    # Find safe king moves
-    filter_moves(king_moves, True)
+    # Find safe king moves, i.e. those not landing on a square the opposition attacks
+    kingside_clear = False
+    queenside_clear = False
+
+    if king_moves or castling_moves:
+        if attack_map is None:
+            attack_map = attacked_squares(
+                opposition_bbs, not is_whites_move, occupied ^ player_bbs[5]
+            )
+
+        for move in king_moves:
+            end_sq = (move >> 6) & 0x3F
+            if (1 << end_sq) & attack_map:
+                continue
+
+            legal_moves.append(move)
+
+            # Set variables for castling
+            move_delta = end_sq - origin_king_square
+            if move_delta == 1:
+                kingside_clear = True
+            elif move_delta == -1:
+                queenside_clear = True
 
     # Find piece moves leaving king safe
     filter_moves(piece_moves + pawn_moves)
 
-    if len(castling_moves) == 0:
-        return legal_moves
-
     # Cannot castle out of check
-    king_bb = player_bbs[5]
-    king_square = king_bb.bit_length() - 1
-
-    if is_square_attacked(king_square, opposition_bbs, player_bbs, not is_whites_move):
+    if not castling_moves or checkers_bb:
         return legal_moves
 
     for move in castling_moves:
-        start_square = move[0]
-        end_square = move[1]
-        move_delta = end_square - start_square
+        end_bit = 1 << ((move >> 6) & 0x3F)
+        flag = move >> 12
 
         # King doesn't pass through check and doesn't land in check
-        if (
-            move_delta == 2
-            and kingside_clear
-            and not is_square_attacked(end_square, opposition_bbs, player_bbs, not is_whites_move)
-        ):
+        if flag == KING_CASTLE and kingside_clear and not end_bit & attack_map:
             legal_moves.append(move)
-        elif (
-            move_delta == -2
-            and queenside_clear
-            and not is_square_attacked(end_square, opposition_bbs, player_bbs, not is_whites_move)
-        ):
+        elif flag == QUEEN_CASTLE and queenside_clear and not end_bit & attack_map:
             legal_moves.append(move)
 
     return legal_moves
 
 
-# @profiled()
-def is_promotion_square(end_idx, is_whites_move):
+def pseudo_move_is_legal(
+    move,
+    player_bbs,
+    opposition_bbs,
+    is_whites_move,
+    en_passant_temp_idx,
+    en_passant_real_idx,
+    king_lines,
+    attack_map=None,
+):
     """
-    Detects if a square is a promotion square for a players pawn
+    Check if a pseudo-legal move leaves the king safe, using the position's `king_lines`
+
+    This is `filter_legal_moves` for a single move, so the search can defer legality until a move
+    is about to be made. `attack_map` is only used by king moves and built if not passed in
     """
 
-    return (is_whites_move and end_idx >= 56) or (not is_whites_move and end_idx <= 7)
+    start_sq, end_sq, flag = move & 0x3F, (move >> 6) & 0x3F, move >> 12
+    end_bit = 1 << end_sq
+    king_square, checkers_bb, pinned_bb, evasion_mask = king_lines
+
+    if start_sq == king_square:
+        if attack_map is None:
+            player_occ, opposition_occ = get_occupancies(player_bbs, opposition_bbs)
+            attack_map = attacked_squares(
+                opposition_bbs, not is_whites_move, (player_occ | opposition_occ) ^ player_bbs[5]
+            )
+
+        # Castling can't start in, pass through or end in check
+        if flag == KING_CASTLE:
+            return not checkers_bb and not ((1 << (start_sq + 1)) | end_bit) & attack_map
+        if flag == QUEEN_CASTLE:
+            return not checkers_bb and not ((1 << (start_sq - 1)) | end_bit) & attack_map
+
+        return not end_bit & attack_map
+
+    # En passant can uncover a check along the rank, so play it out
+    if flag == EP_CAPTURE:
+        new_player_bbs, new_opposition_bbs = apply_move_lightweight(
+            player_bbs, opposition_bbs, move, en_passant_temp_idx, en_passant_real_idx
+        )
+        return not is_square_attacked(
+            king_square, new_opposition_bbs, new_player_bbs, not is_whites_move
+        )
+
+    if checkers_bb:
+        # Double check, so king must move
+        if checkers_bb & (checkers_bb - 1):
+            return False
+
+        # Must capture or block the checker
+        if not end_bit & evasion_mask:
+            return False
+
+    # Pinned pieces can only move up/down the pin
+    return not (1 << start_sq) & pinned_bb or bool(end_bit & LINE[king_square][start_sq])
 
 
 # @profiled()
@@ -881,7 +1021,7 @@ def apply_move(
     Apply a users move to their bitboard, and return the modified bitboards
     """
 
-    start_idx, end_idx, promotion_piece = move
+    start_idx, end_idx, flag = move & 0x3F, (move >> 6) & 0x3F, move >> 12
     move_delta = end_idx - start_idx
     start_square, end_square = 1 << start_idx, 1 << end_idx
 
@@ -927,8 +1067,8 @@ def apply_move(
             elif idx == 0:
                 new_halfmove_clock = 0
 
-                if is_promotion_square(end_idx, is_whites_move):
-                    promotion_idx = piece_to_bitboard_index(promotion_piece)
+                if move & PROMOTION_BIT:
+                    promotion_idx = (flag & 0b11) + 1
                     new_player[0] ^= start_square  # Remove pawn
                     new_player[promotion_idx] ^= end_square  # Promote to correct piece
                     break
@@ -971,186 +1111,357 @@ def apply_move(
 
 # @profiled()
 def find_pseudo_legal_moves(
-    player_bbs, opposition_bbs, is_whites_move, castling_rights, en_passant_temp_idx
+    player_bbs,
+    opposition_bbs,
+    is_whites_move,
+    castling_rights,
+    en_passant_temp_idx,
+    gen_type=GEN_ALL,
+    occupancies=None,
 ):
     """
-    Find all pseudo-legal moves for the given player
+    Find all pseudo-legal moves for the given player, restricted to noisy or quiet moves by `gen_type`
 
     Returns a list of all capturing moves, castling moves, and forward pawn moves
     """
 
-    player_occ = (
-        player_bbs[0]
-        | player_bbs[1]
-        | player_bbs[2]
-        | player_bbs[3]
-        | player_bbs[4]
-        | player_bbs[5]
-    )
-    opposition_occ = (
-        opposition_bbs[0]
-        | opposition_bbs[1]
-        | opposition_bbs[2]
-        | opposition_bbs[3]
-        | opposition_bbs[4]
-        | opposition_bbs[5]
-    )
+    if occupancies is None:
+        occupancies = get_occupancies(player_bbs, opposition_bbs)
+    player_occ, opposition_occ = occupancies
     pawn_bb, knight_bb, bishop_bb, rook_bb, queen_bb, king_bb = player_bbs
 
-    # Store pseudo-legal moves for each piece type as (start square, end square, promotion piece)
+    # Squares pieces may move to
+    target_mask = ALL_SQUARES
+    if gen_type == GEN_NOISY:
+        target_mask = opposition_occ
+        castling_rights = 0
+    elif gen_type == GEN_QUIET:
+        target_mask = ~(player_occ | opposition_occ)
+
+    # Store pseudo-legal moves for each piece type as packed moves
     pawn_capturing_moves, pawn_moves = find_pawn_moves(
-        pawn_bb, player_occ, opposition_occ, is_whites_move, en_passant_temp_idx
+        pawn_bb, player_occ, opposition_occ, is_whites_move, en_passant_temp_idx, gen_type
     )
+
     king_moves, castling_moves = find_king_moves(
-        king_bb, rook_bb, player_occ, opposition_occ, is_whites_move, castling_rights
+        king_bb, rook_bb, player_occ, opposition_occ, is_whites_move, castling_rights, target_mask
     )
     piece_capturing_moves = (
         pawn_capturing_moves
-        + find_knight_moves(knight_bb, player_occ)
-        + find_bishop_moves(bishop_bb, player_occ, opposition_occ)
-        + find_rook_moves(rook_bb, player_occ, opposition_occ)
-        + find_queen_moves(queen_bb, player_occ, opposition_occ)
+        + find_knight_moves(knight_bb, player_occ, opposition_occ, target_mask)
+        + find_bishop_moves(bishop_bb, player_occ, opposition_occ, target_mask)
+        + find_rook_moves(rook_bb, player_occ, opposition_occ, target_mask)
+        + find_queen_moves(queen_bb, player_occ, opposition_occ, target_mask)
     )
 
     return piece_capturing_moves, king_moves, castling_moves, pawn_moves
 
 
+# Move generators for pieces which don't need extra position information, by bitboard index
+PIECE_MOVE_FINDERS = {
+    1: find_knight_moves,
+    2: find_bishop_moves,
+    3: find_rook_moves,
+    4: find_queen_moves,
+}
+
+
 # @profiled()
-def is_square_attacked(target, attacker_bbs, defender_bbs, attacker_is_white):
+def is_square_attacked(target, attacker_bbs, defender_bbs, attacker_is_white, occupied=None):
     """
     A function that checks if a square is attacked from a players set of bitboards
+
+    `occupied` can be passed in when the occupancy of both sides is already known
     """
 
-    def _hit(src):
-        """
-        Check if a provided square is on the board and is a pawn
-        """
+    pawn_bb, knight_bb, bishop_bb, rook_bb, queen_bb, king_bb = attacker_bbs
 
-        return 0 <= src <= 63 and ((1 << src) & pawn_bb)
+    # Check if a pawn attacks the target, i.e. sits where a defending pawn on the target would attack
+    defender_pawn_attacks = BLACK_PAWN_ATTACKS if attacker_is_white else WHITE_PAWN_ATTACKS
+    if defender_pawn_attacks[target] & pawn_bb:
+        return True
 
-    def _ray_attacked(dr, df, attackers, all_occupied):
-        """
-        Check if target is attacked by a ray specified by dr and df
-        """
+    # Check if a knight or king attacks the target
+    if KNIGHT_ATTACKS[target] & knight_bb or KING_ATTACKS[target] & king_bb:
+        return True
+
+    if occupied is None:
+        occupied = 0
+        for bb in attacker_bbs:
+            occupied |= bb
+        for bb in defender_bbs:
+            occupied |= bb
 
-        rank, file = target_rank + dr, target_file + df
-        while 0 <= rank <= 7 and 0 <= file <= 7:
-            square = 8 * rank + file
-            bit = 1 << square
+    # Check if a bishop/queen diagonal attacks the target
+    if BISHOP_TABLES[target][occupied & BISHOP_MASKS[target]] & (bishop_bb | queen_bb):
+        return True
 
-            # first blocker of the ray
-            if bit & all_occupied:
-                return bool(bit & attackers)
+    # Check if a rook/queen horizontal/vertical attacks the target
+    if ROOK_TABLES[target][occupied & ROOK_MASKS[target]] & (rook_bb | queen_bb):
+        return True
 
-            rank += dr
-            file += df
+    return False
 
-        return False
 
-    target_file = target & 7
-    target_rank = target >> 3
+def attackers_to(target, occupied, attacker_bbs, attacker_is_white):
+    """
+    Get a bitboard of every piece in `attacker_bbs` attacking the target square, with sliders
+    blocked by `occupied`
+    """
 
     pawn_bb, knight_bb, bishop_bb, rook_bb, queen_bb, king_bb = attacker_bbs
 
-    occupied = 0
-    for bb in attacker_bbs:
-        occupied |= bb
-    for bb in defender_bbs:
-        occupied |= bb
+    # Attacking pawns sit where a defending pawn on the target would attack
+    defender_pawn_attacks = BLACK_PAWN_ATTACKS if attacker_is_white else WHITE_PAWN_ATTACKS
 
-    # Check if a pawn attacks the target
-    if attacker_is_white:
-        if target_file != 0 and _hit(target - 9):
-            return True
-        if target_file != 7 and _hit(target - 7):
-            return True
+    return (
+        (defender_pawn_attacks[target] & pawn_bb)
+        | (KNIGHT_ATTACKS[target] & knight_bb)
+        | (KING_ATTACKS[target] & king_bb)
+        | (BISHOP_TABLES[target][occupied & BISHOP_MASKS[target]] & (bishop_bb | queen_bb))
+        | (ROOK_TABLES[target][occupied & ROOK_MASKS[target]] & (rook_bb | queen_bb))
+    )
+
+
+# @profiled()
+def see(state: SearchState, move):
+    """
+    Static exchange evaluation of a capture: the material the moving side wins (or loses if
+    negative) once both sides have recaptured on the target square for as long as it pays off,
+    always with their least valuable attacker
+
+    Pins and checks are ignored, while sliders lined up behind a capturing piece join in once it has
+    left its square
+    """
+
+    start_sq, end_sq, flag = move & 0x3F, (move >> 6) & 0x3F, move >> 12
+    board = state.board
+
+    occupied = state.occupied ^ (1 << start_sq)
+    piece_value = SEE_VALUES[board[start_sq]]
+
+    if flag == EP_CAPTURE:
+        gain = SEE_VALUES[0]
+        occupied ^= 1 << state.en_passant_real_idx
     else:
-        if target_file != 0 and _hit(target + 7):
-            return True
-        if target_file != 7 and _hit(target + 9):
-            return True
+        victim_idx = board[end_sq]
+        gain = 0 if victim_idx is None else SEE_VALUES[victim_idx]
 
-    # Check if a knight attacks the target
-    knight_moves = [(2, -1), (2, 1), (1, 2), (1, -2), (-2, 1), (-2, -1), (-1, -2), (-1, 2)]
-    for df, dr in knight_moves:
-        move_file = target_file + df
-        move_rank = target_rank + dr
-        if move_file < 0 or move_file > 7 or move_rank < 0 or move_rank > 7:
-            continue
+    # A promoting pawn gains the difference, and is recaptured as the promoted piece
+    if move & PROMOTION_BIT:
+        piece_value = SEE_VALUES[(flag & 0b11) + 1]
+        gain += piece_value - SEE_VALUES[0]
 
-        move_square = 8 * move_rank + move_file
-        if knight_bb & (1 << move_square):
-            return True
+    player_bbs, opposition_bbs = state.player_bbs, state.opposition_bbs
+    diagonal_bb = player_bbs[2] | player_bbs[4] | opposition_bbs[2] | opposition_bbs[4]
+    orthogonal_bb = player_bbs[3] | player_bbs[4] | opposition_bbs[3] | opposition_bbs[4]
 
-    # Check if a king attacks the target
-    king_moves = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
-    for df, dr in king_moves:
-        move_file = target_file + df
-        move_rank = target_rank + dr
-        if move_file < 0 or move_file > 7 or move_rank < 0 or move_rank > 7:
-            continue
+    attackers = (
+        attackers_to(end_sq, occupied, opposition_bbs, not state.is_whites_move)
+        | attackers_to(end_sq, occupied, player_bbs, state.is_whites_move)
+    ) & occupied
 
-        move_square = 8 * move_rank + move_file
-        if king_bb & (1 << move_square):
-            return True
+    # Balance after each capture in the sequence, from the point of view of the side making it
+    gains = [gain]
 
-    # Check if a bishop/queen diagonal attacks the target
-    attacking_bbs = bishop_bb | queen_bb
-    if (
-        _ray_attacked(1, 1, attacking_bbs, occupied)
-        or _ray_attacked(1, -1, attacking_bbs, occupied)
-        or _ray_attacked(-1, -1, attacking_bbs, occupied)
-        or _ray_attacked(-1, 1, attacking_bbs, occupied)
-    ):
-        return True
+    # The opposition recaptures first
+    side_bbs, other_bbs = opposition_bbs, player_bbs
+    side_occ, other_occ = state.opposition_occ, state.player_occ
 
-    # Check if a rook/queen horizontal/vertical attacks the target
-    attacking_bbs = rook_bb | queen_bb
-    if (
-        _ray_attacked(1, 0, attacking_bbs, occupied)
-        or _ray_attacked(-1, 0, attacking_bbs, occupied)
-        or _ray_attacked(0, -1, attacking_bbs, occupied)
-        or _ray_attacked(0, 1, attacking_bbs, occupied)
-    ):
-        return True
+    while True:
+        side_attackers = attackers & side_occ
+        if not side_attackers:
+            break
 
-    return False
+        for piece_idx, bb in enumerate(side_bbs):
+            if bb & side_attackers:
+                break
+
+        gains.append(piece_value - gains[-1])
+        piece_value = SEE_VALUES[piece_idx]
+
+        bit = bb & side_attackers
+        occupied ^= bit & -bit
+
+        # Uncover any sliders behind the capturing piece
+        attackers = (
+            attackers
+            | BISHOP_TABLES[end_sq][occupied & BISHOP_MASKS[end_sq]] & diagonal_bb
+            | ROOK_TABLES[end_sq][occupied & ROOK_MASKS[end_sq]] & orthogonal_bb
+        ) & occupied
+
+        side_bbs, other_bbs = other_bbs, side_bbs
+        side_occ, other_occ = other_occ, side_occ
+
+    # Each side may stop capturing instead, when continuing would lose material
+    while len(gains) > 1:
+        last = gains.pop()
+        gains[-1] = min(gains[-1], -last)
+
+    return gains[0]
+
+
+def attacked_squares(attacker_bbs, attacker_is_white, occupied):
+    """
+    Get a bitboard of every square attacked by the pieces in `attacker_bbs`, with sliders blocked
+    by `occupied`
+
+    Used as the attack map of the side not to move, which should be built with the defending king
+    removed from `occupied` so squares behind the king along a slider's ray count as attacked
+    """
+
+    pawn_bb, knight_bb, bishop_bb, rook_bb, queen_bb, king_bb = attacker_bbs
+
+    attacked = pawn_attacks_bb(pawn_bb, attacker_is_white)
+
+    while knight_bb:
+        bit = knight_bb & -knight_bb
+        attacked |= KNIGHT_ATTACKS[bit.bit_length() - 1]
+        knight_bb ^= bit
+
+    diagonal_bb = bishop_bb | queen_bb
+    while diagonal_bb:
+        bit = diagonal_bb & -diagonal_bb
+        square = bit.bit_length() - 1
+        attacked |= BISHOP_TABLES[square][occupied & BISHOP_MASKS[square]]
+        diagonal_bb ^= bit
+
+    orthogonal_bb = rook_bb | queen_bb
+    while orthogonal_bb:
+        bit = orthogonal_bb & -orthogonal_bb
+        square = bit.bit_length() - 1
+        attacked |= ROOK_TABLES[square][occupied & ROOK_MASKS[square]]
+        orthogonal_bb ^= bit
+
+    if king_bb:
+        attacked |= KING_ATTACKS[king_bb.bit_length() - 1]
+
+    return attacked
+
+
+@dataclass(slots=True)
+class CheckInfo:
+    king_square: int  # opposition king
+    occupied: int
+    check_squares: list[int]  # by bitboard index, squares a piece would give check from
+    discover_candidates: int  # own pieces which uncover a slider check if they leave its line
+
+
+def get_check_info(player_bbs, opposition_bbs, is_whites_move, occupancies=None):
+    """
+    Build the `CheckInfo` of a position for the side to move, so `move_gives_check` can answer
+    most moves with a few bitmask tests
+    """
+
+    if occupancies is None:
+        occupancies = get_occupancies(player_bbs, opposition_bbs)
+    player_occ, opposition_occ = occupancies
+    occupied = player_occ | opposition_occ
+
+    king_square = opposition_bbs[5].bit_length() - 1
+
+    bishop_checks = bishop_attacks(king_square, occupied)
+    rook_checks = rook_attacks(king_square, occupied)
+    check_squares = [
+        # Our pawns check from where an opposition pawn on the king square would attack
+        pawn_attacks_for(not is_whites_move)[king_square],
+        KNIGHT_ATTACKS[king_square],
+        bishop_checks,
+        rook_checks,
+        bishop_checks | rook_checks,
+        0,
+    ]
+
+    # Our sliders lined up with the king with exactly one of our own pieces in between
+    discover_candidates = 0
+    rook_snipers = ROOK_TABLES[king_square][0] & (player_bbs[3] | player_bbs[4])
+    bishop_snipers = BISHOP_TABLES[king_square][0] & (player_bbs[2] | player_bbs[4])
+    snipers = rook_snipers | bishop_snipers
+    between = BETWEEN[king_square]
+
+    while snipers:
+        bit = snipers & -snipers
+        blockers = between[bit.bit_length() - 1] & occupied
+        if blockers and blockers & (blockers - 1) == 0 and blockers & player_occ:
+            discover_candidates |= blockers
+        snipers ^= bit
+
+    return CheckInfo(king_square, occupied, check_squares, discover_candidates)
 
 
 def move_gives_check(
-    move, player_bbs, opposition_bbs, is_whites_move, en_passant_temp_idx, en_passant_real_idx
+    move,
+    player_bbs,
+    opposition_bbs,
+    is_whites_move,
+    en_passant_temp_idx,
+    en_passant_real_idx,
+    board=None,
+    check_info=None,
 ):
     """
     See if a provided move gives a check to the opposition
 
-    This can be optimised
+    `board` is the optional piece-on-square list of a `SearchState`, used to find the moved and
+    captured pieces without scanning the bitboards. With `check_info` as well, only en passant and
+    castling moves are replayed on copied bitboards
     """
 
-    start_sq, end_sq, promo = move
+    start_sq, end_sq, flag = move & 0x3F, (move >> 6) & 0x3F, move >> 12
     start_bit, end_bit = 1 << start_sq, 1 << end_sq
+
+    if check_info is not None and flag not in (EP_CAPTURE, KING_CASTLE, QUEEN_CASTLE):
+        king_square = check_info.king_square
+
+        # Direct check, promotions look through the square the pawn left
+        if move & PROMOTION_BIT:
+            occupied = check_info.occupied ^ start_bit
+            promo_idx = (flag & 0b11) + 1
+            if promo_idx == 1:
+                promo_attacks = KNIGHT_ATTACKS[end_sq]
+            elif promo_idx == 2:
+                promo_attacks = bishop_attacks(end_sq, occupied)
+            elif promo_idx == 3:
+                promo_attacks = rook_attacks(end_sq, occupied)
+            else:
+                promo_attacks = queen_attacks(end_sq, occupied)
+
+            if promo_attacks & (1 << king_square):
+                return True
+        elif end_bit & check_info.check_squares[board[start_sq]]:
+            return True
+
+        # Discovered check, unless the piece stays on the line between the slider and the king
+        return bool(
+            start_bit & check_info.discover_candidates and not end_bit & LINE[king_square][start_sq]
+        )
+
     king_square = opposition_bbs[5].bit_length() - 1
 
     new_player_bbs = player_bbs[:]
     new_opposition_bbs = opposition_bbs[:]
 
-    for idx, bb in enumerate(player_bbs):
-        if bb & start_bit:
-            moved_piece_idx = idx
-            break
+    if board is not None:
+        moved_piece_idx = board[start_sq]
+    else:
+        for idx, bb in enumerate(player_bbs):
+            if bb & start_bit:
+                moved_piece_idx = idx
+                break
 
     # "Pick-up" moved piece
     new_player_bbs[moved_piece_idx] ^= start_bit
 
     # Place moved piece
     if moved_piece_idx == 0:
-        if promo is not None:
-            promo_idx = piece_to_bitboard_index(promo)
+        if move & PROMOTION_BIT:
+            promo_idx = (flag & 0b11) + 1
             new_player_bbs[promo_idx] ^= end_bit
         else:
             new_player_bbs[0] ^= end_bit
 
             # Remove en passanted pawn
-            if end_sq == en_passant_temp_idx:
+            if flag == EP_CAPTURE:
                 new_opposition_bbs[0] ^= 1 << en_passant_real_idx
     elif moved_piece_idx == 5:
         new_player_bbs[5] ^= end_bit
@@ -1168,10 +1479,14 @@ def move_gives_check(
         new_player_bbs[moved_piece_idx] ^= end_bit
 
     # Remove captured piece
-    for idx, bb in enumerate(new_opposition_bbs):
-        if bb & end_bit:
-            new_opposition_bbs[idx] ^= end_bit
-            break
+    if board is not None:
+        if flag & CAPTURE and flag != EP_CAPTURE:
+            new_opposition_bbs[board[end_sq]] ^= end_bit
+    else:
+        for idx, bb in enumerate(new_opposition_bbs):
+            if bb & end_bit:
+                new_opposition_bbs[idx] ^= end_bit
+                break
 
     # Check if move directly attacks king
     return is_square_attacked(king_square, new_player_bbs, new_opposition_bbs, is_whites_move)
@@ -1185,15 +1500,28 @@ def find_legal_moves(
     castling_rights,
     en_passant_temp_idx,
     en_passant_real_idx,
+    gen_type=GEN_ALL,
+    king_lines=None,
+    occupancies=None,
+    attack_map=None,
 ):
     """
-    Find all legal moves for the given player
+    Find all legal moves for the given player, restricted to noisy or quiet moves by `gen_type`
 
     Returns a list of all capturing moves and a list of non-capturing moves (i.e. forward pawn moves)
     """
 
+    if occupancies is None:
+        occupancies = get_occupancies(player_bbs, opposition_bbs)
+
     pseudo_legal_moves = find_pseudo_legal_moves(
-        player_bbs, opposition_bbs, is_whites_move, castling_rights, en_passant_temp_idx
+        player_bbs,
+        opposition_bbs,
+        is_whites_move,
+        castling_rights,
+        en_passant_temp_idx,
+        gen_type,
+        occupancies,
     )
 
     legal_moves = filter_legal_moves(
@@ -1203,6 +1531,160 @@ def find_legal_moves(
         is_whites_move,
         en_passant_temp_idx,
         en_passant_real_idx,
+        king_lines,
+        occupancies,
+        attack_map,
     )
 
     return legal_moves
+
+
+# @profiled()
+def find_evasion_moves(
+    player_bbs,
+    opposition_bbs,
+    is_whites_move,
+    en_passant_temp_idx,
+    en_passant_real_idx,
+    gen_type=GEN_ALL,
+    king_lines=None,
+    occupancies=None,
+    attack_map=None,
+):
+    """
+    Find all legal moves for a player in check, restricted to noisy or quiet moves by `gen_type`
+
+    Only king moves are generated in double check, and otherwise only king moves and moves which
+    capture or block the single checker. Pinned pieces can never do either, so they are skipped.
+    Moves come out in the same order as `find_legal_moves`, which can be used instead but generates
+    every pseudo-legal move before filtering out most of them
+    """
+
+    if occupancies is None:
+        occupancies = get_occupancies(player_bbs, opposition_bbs)
+    player_occ, opposition_occ = occupancies
+    occupied = player_occ | opposition_occ
+
+    if king_lines is None:
+        king_lines = analyse_king_lines(player_bbs, opposition_bbs, is_whites_move, occupancies)
+    king_square, checkers_bb, pinned_bb, evasion_mask = king_lines
+
+    if attack_map is None:
+        attack_map = attacked_squares(opposition_bbs, not is_whites_move, occupied ^ player_bbs[5])
+
+    target_mask = ALL_SQUARES
+    if gen_type == GEN_NOISY:
+        target_mask = opposition_occ
+    elif gen_type == GEN_QUIET:
+        target_mask = ~occupied
+
+    legal_moves = []
+
+    # King steps to squares the opposition doesn't attack, castling is never allowed in check
+    king_targets = KING_ATTACKS[king_square] & ~player_occ & ~attack_map & target_mask
+    append_target_moves(legal_moves, king_square, king_targets, opposition_occ)
+
+    # Double check, so king must move
+    if checkers_bb & (checkers_bb - 1):
+        return legal_moves
+
+    free_bbs = [bb & ~pinned_bb for bb in player_bbs]
+    piece_mask = evasion_mask & target_mask
+
+    pawn_capturing_moves, pawn_moves = find_pawn_moves(
+        free_bbs[0],
+        player_occ,
+        opposition_occ,
+        is_whites_move,
+        en_passant_temp_idx,
+        gen_type,
+        evasion_mask,
+    )
+
+    # En passant isn't limited by the evasion mask, so check it by playing it out
+    if en_passant_temp_idx >= 0 and gen_type != GEN_QUIET:
+        for move in [move for move in pawn_capturing_moves if move >> 12 == EP_CAPTURE]:
+            new_player_bbs, new_opposition_bbs = apply_move_lightweight(
+                player_bbs, opposition_bbs, move, en_passant_temp_idx, en_passant_real_idx
+            )
+            if is_square_attacked(
+                king_square, new_opposition_bbs, new_player_bbs, not is_whites_move
+            ):
+                pawn_capturing_moves.remove(move)
+
+    return (
+        legal_moves
+        + pawn_capturing_moves
+        + find_knight_moves(free_bbs[1], player_occ, opposition_occ, piece_mask)
+        + find_bishop_moves(free_bbs[2], player_occ, opposition_occ, piece_mask)
+        + find_rook_moves(free_bbs[3], player_occ, opposition_occ, piece_mask)
+        + find_queen_moves(free_bbs[4], player_occ, opposition_occ, piece_mask)
+        + pawn_moves
+    )
+
+
+def is_legal_move(
+    move,
+    player_bbs,
+    opposition_bbs,
+    is_whites_move,
+    castling_rights,
+    en_passant_temp_idx,
+    en_passant_real_idx,
+    king_lines=None,
+    occupancies=None,
+    board=None,
+    attack_map=None,
+):
+    """
+    Check if a move from outside the current position (e.g. a TT or killer move) is legal, only
+    generating the moves of the piece on the move's start square
+    """
+
+    start_bit = 1 << (move & 0x3F)
+
+    if occupancies is None:
+        occupancies = get_occupancies(player_bbs, opposition_bbs)
+    player_occ, opposition_occ = occupancies
+
+    if not start_bit & player_occ:
+        return False
+
+    if board is not None:
+        piece_idx = board[move & 0x3F]
+    else:
+        for piece_idx, bb in enumerate(player_bbs):
+            if bb & start_bit:
+                break
+
+    if piece_idx == 0:
+        pawn_capturing_moves, pawn_moves = find_pawn_moves(
+            start_bit, player_occ, opposition_occ, is_whites_move, en_passant_temp_idx
+        )
+        pseudo_legal_moves = (pawn_capturing_moves, [], [], pawn_moves)
+    elif piece_idx == 5:
+        # Castling legality depends on the king's one step moves, so keep all of them
+        king_moves, castling_moves = find_king_moves(
+            start_bit, player_bbs[3], player_occ, opposition_occ, is_whites_move, castling_rights
+        )
+        pseudo_legal_moves = ([], king_moves, castling_moves, [])
+    else:
+        piece_moves = PIECE_MOVE_FINDERS[piece_idx](start_bit, player_occ, opposition_occ)
+        pseudo_legal_moves = (piece_moves, [], [], [])
+
+    if not any(move in moves for moves in pseudo_legal_moves):
+        return False
+
+    legal_moves = filter_legal_moves(
+        pseudo_legal_moves,
+        player_bbs,
+        opposition_bbs,
+        is_whites_move,
+        en_passant_temp_idx,
+        en_passant_real_idx,
+        king_lines,
+        occupancies,
+        attack_map,
+    )
+
+    return move in legal_moves
@@ -0,0 +1,380 @@
+import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from engine import make_move_with_key
+from moves import (
+    SearchState,
+    analyse_king_lines,
+    attacked_squares,
+    find_legal_moves,
+    find_pseudo_legal_moves,
+    make_move_inplace,
+    pseudo_move_is_legal,
+    unmake_move_inplace,
+)
+from uci import Position, move_to_uci, parse_fen
+from zobrist import compute_polyglot_key
+
+# Standard perft positions with their known node counts, starting from depth 1
+PERFT_POSITIONS = [
+    (
+        "startpos",
+        "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+        [20, 400, 8_902, 197_281, 4_865_609],
+    ),
+    (
+        "kiwipete",
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        [48, 2_039, 97_862, 4_085_603, 193_690_690],
+    ),
+    (
+        "position3",
+        "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        [14, 191, 2_812, 43_238, 674_624],
+    ),
+    (
+        "position4",
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        [6, 264, 9_467, 422_333, 15_833_292],
+    ),
+    (
+        "position5",
+        "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        [44, 1_486, 62_379, 2_103_487, 89_941_194],
+    ),
+    (
+        "position6",
+        "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+        [46, 2_079, 89_890, 3_894_594, 164_075_551],
+    ),
+]
+
+# Perft cache of each worker process when splitting root moves with `--jobs`
+_WORKER_CACHE = {}
+
+
+def state_from_position(position: Position) -> SearchState:
+    """
+    Build a `SearchState` from a UCI `Position`, copying the bitboards so the position is untouched
+    """
+
+    if position.is_whites_move:
+        player_bbs, opposition_bbs = position.white_bbs, position.black_bbs
+    else:
+        player_bbs, opposition_bbs = position.black_bbs, position.white_bbs
+
+    return SearchState(
+        player_bbs[:],
+        opposition_bbs[:],
+        position.is_whites_move,
+        position.castling_rights,
+        position.en_passant_temp_idx,
+        position.en_passant_real_idx,
+        position.halfmove_clock,
+    )
+
+
+def state_key(state: SearchState):
+    """
+    Compute the zobrist key of a `SearchState` from scratch
+    """
+
+    if state.is_whites_move:
+        white_bbs, black_bbs = state.player_bbs, state.opposition_bbs
+    else:
+        white_bbs, black_bbs = state.opposition_bbs, state.player_bbs
+
+    return compute_polyglot_key(
+        white_bbs, black_bbs, state.castling_rights, state.en_passant_temp_idx, state.is_whites_move
+    )
+
+
+def find_moves(state: SearchState, pseudo_legal=False):
+    """
+    Find the legal moves of `state`, either from the legal generator or, with `pseudo_legal`, by
+    checking each pseudo-legal move the way the pseudo-legal search does
+    """
+
+    occupancies = (state.player_occ, state.opposition_occ)
+
+    if not pseudo_legal:
+        return find_legal_moves(
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            state.castling_rights,
+            state.en_passant_temp_idx,
+            state.en_passant_real_idx,
+            occupancies=occupancies,
+        )
+
+    piece_moves, king_moves, castling_moves, pawn_moves = find_pseudo_legal_moves(
+        state.player_bbs,
+        state.opposition_bbs,
+        state.is_whites_move,
+        state.castling_rights,
+        state.en_passant_temp_idx,
+        occupancies=occupancies,
+    )
+    king_lines = analyse_king_lines(
+        state.player_bbs, state.opposition_bbs, state.is_whites_move, occupancies
+    )
+    attack_map = attacked_squares(
+        state.opposition_bbs, not state.is_whites_move, state.occupied ^ state.player_bbs[5]
+    )
+
+    return [
+        move
+        for move in king_moves + piece_moves + pawn_moves + castling_moves
+        if pseudo_move_is_legal(
+            move,
+            state.player_bbs,
+            state.opposition_bbs,
+            state.is_whites_move,
+            state.en_passant_temp_idx,
+            state.en_passant_real_idx,
+            king_lines,
+            attack_map,
+        )
+    ]
+
+
+def perft(state: SearchState, depth, cache=None, key=None, pseudo_legal=False, ply=0):
+    """
+    Count the leaf nodes of the legal move tree of `state` to `depth`
+
+    Leaves are bulk counted, i.e. the moves at depth 1 are counted without being made. If a `cache`
+    dict is passed, subtree counts are stored by (zobrist key, depth), with `key` being the key of
+    `state`, and moves are made with the search's records for `ply`. `pseudo_legal` generates moves
+    as in `find_moves`
+    """
+
+    if depth <= 0:
+        return 1
+
+    if cache is not None:
+        if key is None:
+            key = state_key(state)
+
+        nodes = cache.get((key, depth))
+        if nodes is not None:
+            return nodes
+
+    moves = find_moves(state, pseudo_legal)
+
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    if cache is None:
+        for move in moves:
+            undo = make_move_inplace(state, move)
+            nodes += perft(state, depth - 1, pseudo_legal=pseudo_legal)
+            unmake_move_inplace(state, undo)
+    else:
+        for move in moves:
+            undo, child_key = make_move_with_key(state, move, key, ply)
+            nodes += perft(state, depth - 1, cache, child_key, pseudo_legal, ply + 1)
+            unmake_move_inplace(state, undo)
+
+        cache[(key, depth)] = nodes
+
+    return nodes
+
+
+def _perft_root_move(state: SearchState, move, depth, use_hash, pseudo_legal):
+    """
+    Count the nodes below one root move, run inside a worker process
+    """
+
+    if use_hash:
+        _, key = make_move_with_key(state, move, state_key(state), 0)
+        return perft(state, depth - 1, _WORKER_CACHE, key, pseudo_legal, 1)
+
+    make_move_inplace(state, move)
+    return perft(state, depth - 1, pseudo_legal=pseudo_legal)
+
+
+def divide(state: SearchState, depth, use_hash=False, jobs=1, pseudo_legal=False):
+    """
+    Run perft to `depth` separately below each root move
+
+    With `jobs` above 1 the root moves are split across a process pool
+
+    Returns a list of (move, nodes) pairs
+    """
+
+    if depth < 1:
+        raise ValueError(f"divide needs a depth of at least 1, got {depth}")
+
+    moves = find_moves(state, pseudo_legal)
+
+    if depth == 1:
+        return [(move, 1) for move in moves]
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            counts = pool.map(
+                _perft_root_move,
+                [state] * len(moves),
+                moves,
+                [depth] * len(moves),
+                [use_hash] * len(moves),
+                [pseudo_legal] * len(moves),
+            )
+            return list(zip(moves, counts))
+
+    cache = {} if use_hash else None
+    key = state_key(state) if use_hash else None
+
+    results = []
+    for move in moves:
+        if use_hash:
+            undo, child_key = make_move_with_key(state, move, key, 0)
+        else:
+            undo, child_key = make_move_inplace(state, move), None
+
+        results.append((move, perft(state, depth - 1, cache, child_key, pseudo_legal, 1)))
+        unmake_move_inplace(state, undo)
+
+    return results
+
+
+def cross_check(state: SearchState, depth):
+    """
+    Compare the pseudo-legal move checking against the legal generator at every node of the tree
+    of `state` to `depth`
+
+    Returns a list of (moves leading to the node, missing moves, extra moves) for each node where
+    the two disagree, the move lists in UCI notation
+    """
+
+    mismatches = []
+
+    def walk(line, depth):
+        legal_moves = find_moves(state)
+        pseudo_moves = find_moves(state, pseudo_legal=True)
+
+        if set(legal_moves) != set(pseudo_moves):
+            missing = sorted(move_to_uci(move) for move in set(legal_moves) - set(pseudo_moves))
+            extra = sorted(move_to_uci(move) for move in set(pseudo_moves) - set(legal_moves))
+            mismatches.append((" ".join(line), missing, extra))
+
+        if depth <= 1:
+            return
+
+        for move in legal_moves:
+            undo = make_move_inplace(state, move)
+            walk(line + [move_to_uci(move)], depth - 1)
+            unmake_move_inplace(state, undo)
+
+    walk([], depth)
+
+    return mismatches
+
+
+def print_divide(results):
+    """
+    Print divide results in the usual `<move>: <nodes>` format, followed by the node total
+
+    Returns the node total
+    """
+
+    for move, nodes in results:
+        print(f"{move_to_uci(move)}: {nodes}")
+
+    total = sum(nodes for _, nodes in results)
+    print(f"\nNodes searched: {total}", flush=True)
+
+    return total
+
+
+def run_reference_positions(max_depth, use_hash=False, jobs=1, pseudo_legal=False):
+    """
+    Check the perft of every reference position against its known node counts, up to `max_depth`
+
+    Returns True if every count matched
+    """
+
+    all_passed = True
+
+    for name, fen, expected_counts in PERFT_POSITIONS:
+        for depth, expected in enumerate(expected_counts[:max_depth], 1):
+            state = state_from_position(parse_fen(fen))
+
+            start = time.perf_counter()
+            nodes = sum(count for _, count in divide(state, depth, use_hash, jobs, pseudo_legal))
+            elapsed = time.perf_counter() - start
+
+            passed = nodes == expected
+            all_passed = all_passed and passed
+
+            nps = int(nodes / elapsed) if elapsed > 0 else 0
+            status = "ok" if passed else f"FAIL (expected {expected})"
+            print(f"{name} depth {depth}: {nodes} nodes, {elapsed:.2f}s, {nps} nps {status}")
+
+    return all_passed
+
+
+def main():
+    positions = {name: fen for name, fen, _ in PERFT_POSITIONS}
+
+    parser = argparse.ArgumentParser(description="Count the legal move tree of a position")
+    parser.add_argument("depth", type=int, nargs="?", default=3)
+    parser.add_argument("--fen", help="position to run, instead of the reference positions")
+    parser.add_argument("--position", choices=positions, help="reference position to run")
+    parser.add_argument("--divide", action="store_true", help="print the nodes below each move")
+    parser.add_argument("--hash", action="store_true", help="cache subtree counts by zobrist key")
+    parser.add_argument("--jobs", type=int, default=1, help="processes to split root moves over")
+    parser.add_argument(
+        "--pseudo", action="store_true", help="generate pseudo-legal moves checked one by one"
+    )
+    parser.add_argument(
+        "--cross-check",
+        action="store_true",
+        help="compare pseudo-legal checking against the legal generator at every node",
+    )
+    args = parser.parse_args()
+
+    if args.depth < 1:
+        parser.error("depth must be at least 1")
+
+    fen = args.fen or positions.get(args.position)
+
+    if args.cross_check:
+        fens = [fen] if fen is not None else list(positions.values())
+        mismatch_count = 0
+        for check_fen in fens:
+            mismatches = cross_check(state_from_position(parse_fen(check_fen)), args.depth)
+            for line, missing, extra in mismatches:
+                print(f"{check_fen} moves {line}: missing {missing}, extra {extra}")
+            mismatch_count += len(mismatches)
+
+        print(f"Cross-check: {mismatch_count} mismatching nodes")
+        sys.exit(0 if mismatch_count == 0 else 1)
+
+    # No position given, so verify the reference positions instead
+    if fen is None:
+        passed = run_reference_positions(args.depth, args.hash, args.jobs, args.pseudo)
+        sys.exit(0 if passed else 1)
+
+    state = state_from_position(parse_fen(fen))
+
+    start = time.perf_counter()
+    results = divide(state, args.depth, args.hash, args.jobs, args.pseudo)
+    elapsed = time.perf_counter() - start
+
+    if args.divide:
+        total = print_divide(results)
+    else:
+        total = sum(nodes for _, nodes in results)
+        print(f"Nodes searched: {total}")
+
+    nps = int(total / elapsed) if elapsed > 0 else 0
+    print(f"Time: {elapsed:.2f}s ({nps} nps)")
+
+
+if __name__ == "__main__":
+    main()
@@ -54,6 +54,11 @@ def bump_node(search_type=None):
         _ACTIVE_PROFILER.bump_node(search_type)
 
 
+def bump_eval_cache(hit):
+    if ENABLE_PROFILING and _ACTIVE_PROFILER is not None:
+        _ACTIVE_PROFILER.bump_eval_cache(hit)
+
+
 def profiled(label=None, root_only=False):
     """
     Decorator that records call count and runtime for a function when an
@@ -114,6 +119,8 @@ class SearchProfiler:
         self.nodes = 0
         self.negamax_nodes = 0
         self.q_nodes = 0
+        self.eval_cache_hits = 0
+        self.eval_cache_misses = 0
 
     def add_time(self, label, elapsed_s):
         if not self.enabled:
@@ -145,6 +152,17 @@ class SearchProfiler:
                 # Default unknown/None labels to negamax so existing call sites stay useful.
                 self.negamax_nodes += 1
 
+    def bump_eval_cache(self, hit):
+        if ENABLE_PROFILING and self.enabled:
+            if hit:
+                self.eval_cache_hits += 1
+            else:
+                self.eval_cache_misses += 1
+
+    def eval_cache_hit_rate(self):
+        probes = self.eval_cache_hits + self.eval_cache_misses
+        return self.eval_cache_hits / probes if probes else 0.0
+
     def reset(self):
         self.times = {}
         self.calls = {}
@@ -153,6 +171,8 @@ class SearchProfiler:
         self.nodes = 0
         self.negamax_nodes = 0
         self.q_nodes = 0
+        self.eval_cache_hits = 0
+        self.eval_cache_misses = 0
 
     def get_stats(self):
         stats = []
@@ -237,6 +257,8 @@ class SearchProfiler:
             "negamax_nps": negamax_nps,
             "q_nodes": self.q_nodes,
             "q_nps": q_nps,
+            "eval_cache_hits": self.eval_cache_hits,
+            "eval_cache_misses": self.eval_cache_misses,
             "total_ms": total_time_s * 1000.0,
             "functions": functions,
         }
@@ -314,7 +336,9 @@ class SearchProfiler:
                 f"[PROFILE] total={total_time_s:.4f}s depth={depth} "
                 f"nodes={self.nodes} nps={nps} "
                 f"negamax_nodes={self.negamax_nodes} negamax_nps={negamax_nps} "
-                f"q_nodes={self.q_nodes} q_nps={q_nps}{move_suffix}"
+                f"q_nodes={self.q_nodes} q_nps={q_nps} "
+                f"eval_cache_hits={self.eval_cache_hits} "
+                f"eval_cache_hit_rate={self.eval_cache_hit_rate():.1%}{move_suffix}"
             ),
             flush=True,
         )
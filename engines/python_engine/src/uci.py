@@ -3,8 +3,22 @@ import time
 import inspect
 from dataclasses import dataclass
 
-from engine import evaluate_position, clear_history, clear_tt
+from engine import (
+    DEFAULT_HASH_MB,
+    MAX_HASH_MB,
+    evaluate_position,
+    clear_history,
+    clear_tt,
+    set_hash_size,
+)
+from evaluation import (
+    MAX_EVAL_CACHE_SIZE,
+    clear_eval_cache,
+    clear_pawn_hash,
+    set_eval_cache_size,
+)
 from gamestate import BK, BQ, WK, WQ
+from move_encoding import find_matching_move, move_to_tuple
 from moves import apply_move, find_legal_moves, find_pseudo_legal_moves, in_check
 
 # Canonical chess start position (used for uci `position startpos`)
@@ -63,8 +77,8 @@ def index_to_square(index: int) -> str:
     return file_ch + rank_ch
 
 
-def move_to_uci(move: tuple[int, int, str | None]) -> str:
-    start_square, end_square, promotion_piece = move
+def move_to_uci(move: int) -> str:
+    start_square, end_square, promotion_piece = move_to_tuple(move)
     promotion_suffix = promotion_piece if promotion_piece else ""
     return index_to_square(start_square) + index_to_square(end_square) + promotion_suffix
 
@@ -188,7 +202,7 @@ def get_side_bitboards(position: Position) -> tuple[list[int], list[int]]:
     return position.black_bbs, position.white_bbs
 
 
-def generate_legal_moves(position: Position) -> list[tuple[int, int, str | None]]:
+def generate_legal_moves(position: Position) -> list[int]:
     player_bbs, opposition_bbs = get_side_bitboards(position)
     return find_legal_moves(
         player_bbs,
@@ -219,7 +233,7 @@ def is_side_to_move_in_check(position: Position) -> bool:
     return in_check(king_square, opposition_piece_moves + opposition_king_moves)
 
 
-def make_move(position: Position, move: tuple[int, int, str | None]) -> Position:
+def make_move(position: Position, move: int) -> Position:
     player_bbs, opposition_bbs = get_side_bitboards(position)
 
     (
@@ -342,7 +356,7 @@ def search_best_move(
     position: Position,
     go_command: str,
     position_counts: dict,
-) -> tuple[int, int, str | None] | None:
+) -> int | None:
     legal_moves = generate_legal_moves(position)
     if not legal_moves:
         return None
@@ -365,14 +379,59 @@ def search_best_move(
     if not best_move:
         # Always return a move immediately under time pressure.
         best_move = legal_moves[0]
-        best_eval = 0.0
+        best_eval = 0
 
-    cp_score = int(best_eval if position.is_whites_move else -best_eval)
+    cp_score = best_eval if position.is_whites_move else -best_eval
     print(f"info depth {depth} score cp {cp_score} pv {move_to_uci(best_move)}", flush=True)
 
     return best_move
 
 
+def run_perft(position: Position, go_command: str) -> None:
+    # UCI form: go perft <depth>
+    # perft builds on this module's FEN parsing, so it is imported here to avoid a circular import
+    from perft import divide, print_divide, state_from_position
+
+    tokens = go_command.split()
+    try:
+        depth = int(tokens[2])
+    except (IndexError, ValueError):
+        return
+
+    if depth < 1:
+        return
+
+    print_divide(divide(state_from_position(position), depth))
+
+
+def run_setoption(command: str) -> None:
+    # UCI form: setoption name <id> [value <x>]
+    tokens = command.split()
+    if "name" not in tokens:
+        return
+
+    name_start = tokens.index("name") + 1
+    value_start = tokens.index("value") if "value" in tokens else len(tokens)
+    name = " ".join(tokens[name_start:value_start]).lower()
+    value = " ".join(tokens[value_start + 1 :])
+
+    if name == "hash":
+        try:
+            mb = int(value)
+        except ValueError:
+            return
+
+        set_hash_size(min(max(mb, 1), MAX_HASH_MB))
+
+    elif name == "evalcache":
+        try:
+            entries = int(value)
+        except ValueError:
+            return
+
+        set_eval_cache_size(min(max(entries, 0), MAX_EVAL_CACHE_SIZE))
+
+
 def apply_moves_text(position: Position, moves_text: list[str]) -> Position:
     current = position
 
@@ -382,23 +441,9 @@ def apply_moves_text(position: Position, moves_text: list[str]) -> Position:
             break
 
         legal_moves = generate_legal_moves(current)
-        move = None
-
-        for legal in legal_moves:
-            if legal == parsed:
-                move = legal
-                break
-
-            # Accept long algebraic promotion piece in upper-case from some GUIs.
-            if (
-                legal[0] == parsed[0]
-                and legal[1] == parsed[1]
-                and legal[2] is not None
-                and parsed[2] is not None
-                and legal[2].lower() == parsed[2].lower()
-            ):
-                move = legal
-                break
+
+        # Accepts long algebraic promotion piece in upper-case from some GUIs.
+        move = find_matching_move(legal_moves, *parsed)
 
         if move is None:
             break
@@ -455,6 +500,14 @@ def uci_loop() -> None:
         if line == "uci":
             print("id name Chess-AI", flush=True)
             print("id author ayejay", flush=True)
+            print(
+                f"option name Hash type spin default {DEFAULT_HASH_MB} min 1 max {MAX_HASH_MB}",
+                flush=True,
+            )
+            print(
+                f"option name EvalCache type spin default 0 min 0 max {MAX_EVAL_CACHE_SIZE}",
+                flush=True,
+            )
             print("uciok", flush=True)
             continue
 
@@ -462,8 +515,14 @@ def uci_loop() -> None:
             print("readyok", flush=True)
             continue
 
+        if line.startswith("setoption "):
+            run_setoption(line)
+            continue
+
         if line == "ucinewgame":
             clear_tt()
+            clear_eval_cache()
+            clear_pawn_hash()
             clear_history()
             position = initial_position()
             position_counts = {}
@@ -479,6 +538,10 @@ def uci_loop() -> None:
                 position_counts = {}
             continue
 
+        if line.startswith("go perft"):
+            run_perft(position, line)
+            continue
+
         if line.startswith("go"):
             best_move = search_best_move(position, line, position_counts)
             if best_move is None:
@@ -497,7 +560,7 @@ def uci_loop() -> None:
         if line == "ponderhit":
             continue
 
-        # Ignore unsupported commands, including setoption.
+        # Ignore unsupported commands.
 
 
 if __name__ == "__main__":
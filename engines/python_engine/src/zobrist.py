@@ -2,7 +2,7 @@ from dataclasses import dataclass
 
 from polyglot_random import RANDOM64
 from gamestate import WK, WQ, BK, BQ
-from utils import piece_to_bitboard_index
+from move_encoding import KING_CASTLE, PROMOTION_BIT, QUEEN_CASTLE
 
 # piece encodings relative to bitboard index
 kind_of_piece_white = [1, 3, 5, 7, 9, 11]
@@ -61,6 +61,27 @@ def polyglot_ep_file_to_xor(player_pawns_bb, ep_square, is_whites_move):
     return None
 
 
+# Offsets of each colour's pawn entries in RANDOM64, indexed by is_white
+PAWN_KEY_OFFSETS = (64 * kind_of_piece_black[0], 64 * kind_of_piece_white[0])
+
+
+def compute_pawn_key(white_pawn_bb, black_pawn_bb):
+    """
+    Compute a zobrist key of only the pawns, from the same RANDOM64 entries as the polyglot key
+    """
+
+    key = 0
+
+    white_offset, black_offset = PAWN_KEY_OFFSETS[True], PAWN_KEY_OFFSETS[False]
+    for offset, bb in ((white_offset, white_pawn_bb), (black_offset, black_pawn_bb)):
+        while bb:
+            lsb = bb & -bb
+            key ^= RANDOM64[offset + lsb.bit_length() - 1]
+            bb ^= lsb
+
+    return key
+
+
 def compute_polyglot_key(white_bbs, black_bbs, castling_rights, en_passant_idx, is_whites_move):
     """
     Compute the polyglot key for the polyglot opening book using RANDOM64
@@ -117,12 +138,12 @@ def update_key(key, move, pre_state, post_state):
     piece_idx = post_state.moving_piece_idx
     piece_offset = 64 * kind_of_piece[piece_idx]
 
-    start_sq, end_sq, promo = move
+    start_sq, end_sq, flag = move & 0x3F, (move >> 6) & 0x3F, move >> 12
     piece_start_offset = piece_offset + start_sq
 
     # xor correct bits if move is a promotion move
-    if promo is not None:
-        promo_idx = piece_to_bitboard_index(promo)
+    if move & PROMOTION_BIT:
+        promo_idx = (flag & 0b11) + 1
         piece_offset = 64 * kind_of_piece[promo_idx]
 
     piece_end_offset = piece_offset + end_sq
@@ -132,10 +153,8 @@ def update_key(key, move, pre_state, post_state):
     key ^= RANDOM64[piece_end_offset]
 
     # Update rook if move is a castling move
-    move_delta = end_sq - start_sq
-    if abs(move_delta) == 2 and piece_idx == 5:
-        is_kingside_castle = move_delta == 2
-        if is_kingside_castle:
+    if flag == KING_CASTLE or flag == QUEEN_CASTLE:
+        if flag == KING_CASTLE:
             rook_start_idx = start_sq + 3
             rook_end_idx = end_sq - 1
         else: